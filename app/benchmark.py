@@ -0,0 +1,91 @@
+"""
+Microbenchmark harness shared by the app/<service>/bench.py suites.
+
+Each suite maps a benchmark name to a zero-argument callable and hands it to
+main(). Results are ops/sec and allocated bytes per op, and can be saved as a
+JSON baseline and compared against later:
+
+    cd app/flights
+    python bench.py --save bench_baseline.json
+    python bench.py --compare bench_baseline.json
+"""
+
+import argparse
+import json
+import timeit
+import tracemalloc
+from typing import Callable
+
+
+def measure(fn: Callable[[], object], min_time: float = 0.2, repeat: int = 3) -> dict:
+    """
+    Times fn over at least `min_time` seconds and keeps the best of `repeat`
+    rounds, then traces the allocations of a single call.
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    fn()  # warm caches so only the steady-state allocations are traced
+    tracemalloc.start()
+    try:
+        result = fn()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {
+        "opsPerSec": 1 / best,
+        # highest traced memory during the call, and what its result holds on to
+        "peakBytes": peak,
+        "retainedBytes": retained,
+    }
+
+
+def run(benchmarks: dict[str, Callable[[], object]], **kwargs) -> dict:
+    return {name: measure(fn, **kwargs) for name, fn in benchmarks.items()}
+
+
+def compare(results: dict, baseline: dict) -> list[str]:
+    lines = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            lines.append(f"{name}: no baseline")
+            continue
+        speedup = result["opsPerSec"] / base["opsPerSec"]
+        lines.append(
+            f"{name}: {speedup:.2f}x ops/sec, "
+            f"peak {result['peakBytes'] - base['peakBytes']:+d} bytes"
+        )
+    return lines
+
+
+def main(benchmarks: dict[str, Callable[[], object]], argv=None):
+    parser = argparse.ArgumentParser(description="Run microbenchmarks")
+    parser.add_argument("-k", dest="filter", help="run benchmarks containing this")
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--save", metavar="PATH", help="write results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare with a baseline")
+    args = parser.parse_args(argv)
+
+    if args.filter:
+        benchmarks = {k: v for k, v in benchmarks.items() if args.filter in k}
+    results = run(benchmarks, min_time=args.min_time)
+    for name, result in results.items():
+        print(
+            f"{name:40} {result['opsPerSec']:12.1f} ops/sec "
+            f"{result['peakBytes']:10d} peak bytes"
+        )
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        print("\n".join(compare(results, baseline)))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
@@ -0,0 +1,49 @@
+"""
+Microbenchmarks of the bonus service hot paths. See app/benchmark.py.
+"""
+
+from datetime import datetime, timedelta
+from uuid import uuid4
+import os
+
+os.environ.setdefault("TESTING", "True")
+
+from main import PrivilegeDb, PrivilegeHistoryDb
+from common import PrivilegeHistory, PrivilegeSummary
+from benchmark import main
+
+PRIVILEGE = PrivilegeDb(id=1, username="moose", status="GOLD", balance=150_000)
+HISTORY = [
+    PrivilegeHistoryDb(
+        id=i,
+        privilege_id=1,
+        ticket_uid=uuid4(),
+        datetime=datetime(2021, 10, 8) + timedelta(minutes=i),
+        balance_diff=150,
+        operation_type="FILL_IN_BALANCE",
+    )
+    for i in range(1, 1001)
+]
+
+
+def summary():
+    return PrivilegeSummary(
+        id=PRIVILEGE.id,
+        username=PRIVILEGE.username,
+        status=PRIVILEGE.status,
+        balance=PRIVILEGE.balance,
+        history=[PrivilegeHistory.model_validate(h) for h in HISTORY],
+    )
+
+
+BENCHMARKS = {
+    "PrivilegeHistory.model_validate x1000 ORM": lambda: [
+        PrivilegeHistory.model_validate(h) for h in HISTORY
+    ],
+    "PrivilegeSummary 1000 entries": summary,
+    "PrivilegeSummary 1000 entries dump": lambda: summary().model_dump_json(),
+}
+
+
+if __name__ == "__main__":
+    main(BENCHMARKS)
@@ -1,29 +1,47 @@
 import inspect
 import sys
 import uuid
-from fastapi import FastAPI, HTTPException, Depends, Path
+from fastapi import FastAPI, HTTPException, Depends, Path, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy import (
     TIMESTAMP,
+    Index,
+    and_,
+    or_,
     CheckConstraint,
     ForeignKey,
     StaticPool,
-    create_engine,
     Column,
     Integer,
     String,
     UUID,
+    case,
+    delete,
+    func,
+    insert,
+    select,
+    update,
 )
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.orm import declarative_base, relationship
 import os
-
+from contextlib import asynccontextmanager
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 
 from common import *
+from migrations import Migration, create_indexes, migrate
+from metrics import (
+    InFlight,
+    InFlightMiddleware,
+    PoolMetrics,
+    threadpool_stats,
+    track_db_time,
+)
 
 if not os.getenv("TESTING"):
     # Database configuration from environment variables
@@ -32,26 +50,47 @@ if not os.getenv("TESTING"):
     DB_NAME = os.getenv("POSTGRES_DB", "postgres")
     DB_HOST = os.getenv("DB_HOST", "postgres")
     DB_PORT = os.getenv("DB_PORT", "5432")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
 
-    DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    DATABASE_URL = (
+        f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    )
 
     # SQLAlchemy setup
-    engine = create_engine(DATABASE_URL)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine = create_async_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+    SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
     Base = declarative_base()
 else:
     # For tests, create minimal setup
     Base = declarative_base()
 
-    SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+    SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
 
-    engine = create_engine(
+    engine = create_async_engine(
         SQLALCHEMY_DATABASE_URL,
-        connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
+    SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+RUN_MIGRATIONS = (
+    os.getenv("RUN_MIGRATIONS", "0" if os.getenv("TESTING") else "1") == "1"
+)
 
-app = FastAPI(title="Bonus API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if RUN_MIGRATIONS:
+        await migrate(engine, MIGRATIONS)
+    yield
 
 
 class PrivilegeDb(Base):
@@ -88,130 +127,375 @@ class PrivilegeHistoryDb(Base):
             "operation_type IN ('FILL_IN_BALANCE', 'DEBIT_THE_ACCOUNT')",
             name="privilege_operation_type_check",
         ),
+        Index(
+            "ix_privilege_history_privilege_id_ticket_uid", "privilege_id", "ticket_uid"
+        ),
+        Index(
+            "ix_privilege_history_privilege_id_datetime",
+            "privilege_id",
+            "datetime",
+            "id",
+        ),
     )
 
     privilege = relationship("PrivilegeDb", back_populates="history")
 
 
-app = FastAPI(title="Privilege Service", version="1.0")
+MIGRATIONS = [
+    Migration(
+        1,
+        "privilege history indexes",
+        create_indexes(
+            PrivilegeHistoryDb,
+            "ix_privilege_history_privilege_id_ticket_uid",
+            "ix_privilege_history_privilege_id_datetime",
+        ),
+    ),
+]
+
+
+app = FastAPI(title="Privilege Service", version="1.0", lifespan=lifespan)
+inflight = InFlight()
+app.add_middleware(InFlightMiddleware, inflight=inflight)
+instrument(app)
+pool_metrics = PoolMetrics(engine)
+track_db_time(engine)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
+        await pool_metrics.checkout(db)
         yield db
-    finally:
-        db.close()
 
 
 @app.get("/privilege/{username}", response_model=Privilege)
-def get_privilege_by_username(username: str, db: Session = Depends(get_db)):
-    privilege = db.query(PrivilegeDb).filter(PrivilegeDb.username == username).first()
+async def get_privilege_by_username(username: str, db: AsyncSession = Depends(get_db)):
+    # Plain columns straight to JSON, without an ORM object or its validation
+    privilege = (
+        await db.execute(
+            select(*PrivilegeDb.__table__.columns).where(
+                PrivilegeDb.username == username
+            )
+        )
+    ).first()
     if not privilege:
         raise HTTPException(status_code=404, detail="Privilege not found for this user")
-    return privilege
+    return WireResponse(privilege._asdict())
+
+
+@app.get("/privilege/{username}/summary", response_model=PrivilegeSummary)
+async def get_privilege_summary(
+    username: str,
+    limit: Optional[int] = Query(
+        None, ge=1, le=1000, description="Размер страницы истории"
+    ),
+    cursor: Optional[str] = Query(None, description="Курсор страницы истории"),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Balance, status and history (newest first) in a single query: all of it,
+    or with `limit` one page and the cursor of the next.
+    """
+    on_clause = PrivilegeHistoryDb.privilege_id == PrivilegeDb.id
+    if cursor:
+        try:
+            cursor_datetime, cursor_id = decode_cursor(cursor)
+            cursor_datetime = datetime.fromisoformat(cursor_datetime)
+            cursor_id = int(cursor_id)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        on_clause = and_(
+            on_clause,
+            or_(
+                PrivilegeHistoryDb.datetime < cursor_datetime,
+                and_(
+                    PrivilegeHistoryDb.datetime == cursor_datetime,
+                    PrivilegeHistoryDb.id < cursor_id,
+                ),
+            ),
+        )
+
+    # The page condition lives in the join so the privilege row comes back
+    # even when the page is empty.
+    query = (
+        select(PrivilegeDb, PrivilegeHistoryDb)
+        .outerjoin(PrivilegeHistoryDb, on_clause)
+        .where(PrivilegeDb.username == username)
+        .order_by(PrivilegeHistoryDb.datetime.desc(), PrivilegeHistoryDb.id.desc())
+    )
+    if limit is not None:
+        query = query.limit(limit + 1)
+    result = await db.execute(query)
+    rows = result.all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Privilege not found for this user")
+
+    privilege = rows[0][0]
+    history = [h for _, h in rows if h is not None]
+    next_cursor = None
+    if limit is not None and len(history) > limit:
+        history = history[:limit]
+        last = history[-1]
+        next_cursor = encode_cursor(last.datetime.isoformat(), last.id)
+
+    return WireResponse(
+        PrivilegeSummary(
+            id=privilege.id,
+            username=privilege.username,
+            status=privilege.status,
+            balance=privilege.balance,
+            history=[PrivilegeHistory.model_validate(h) for h in history],
+            nextCursor=next_cursor,
+        )
+    )
 
 
 @app.get("/privilege/{username}/history", response_model=List[PrivilegeHistory])
-def get_privilege_history_by_username(username: str, db: Session = Depends(get_db)):
-    privilege = db.query(PrivilegeDb).filter(PrivilegeDb.username == username).first()
+async def get_privilege_history_by_username(
+    username: str, db: AsyncSession = Depends(get_db)
+):
+    privilege = await db.scalar(
+        select(PrivilegeDb).where(PrivilegeDb.username == username)
+    )
     if not privilege:
         raise HTTPException(status_code=404, detail="Privilege not found for this user")
 
-    history = (
-        db.query(PrivilegeHistoryDb)
-        .filter(PrivilegeHistoryDb.privilege_id == privilege.id)
+    history = await db.execute(
+        select(*PrivilegeHistoryDb.__table__.columns)
+        .where(PrivilegeHistoryDb.privilege_id == privilege.id)
         .order_by(PrivilegeHistoryDb.datetime.desc())
-        .all()
     )
 
-    return history
+    return WireResponse([h._asdict() for h in history])
+
+
+@app.get("/privilege/{username}/history/export")
+async def export_privilege_history(
+    username: str, db: AsyncSession = Depends(get_db, scope="request")
+):
+    """
+    Full history (newest first) as NDJSON, read through a server-side cursor
+    so memory stays flat however long the history is.
+    """
+    privilege_id = await db.scalar(
+        select(PrivilegeDb.id).where(PrivilegeDb.username == username)
+    )
+    if privilege_id is None:
+        raise HTTPException(status_code=404, detail="Privilege not found for this user")
+
+    # Plain rows keep the ORM identity map out of the way
+    result = await db.stream(
+        select(*PrivilegeHistoryDb.__table__.columns)
+        .where(PrivilegeHistoryDb.privilege_id == privilege_id)
+        .order_by(PrivilegeHistoryDb.datetime.desc(), PrivilegeHistoryDb.id.desc())
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    return StreamingResponse(ndjson_stream(result), media_type=NDJSON_MEDIA_TYPE)
 
 
 @app.get(
     "/privilege/{username}/history/{ticket_uid}",
     response_model=PrivilegeHistory,
 )
-def get_specific_history_entry(
+async def get_specific_history_entry(
     username: str,
     ticket_uid: uuid.UUID = Path(..., description="UUID билета"),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    privilege = db.query(PrivilegeDb).filter(PrivilegeDb.username == username).first()
+    privilege = await db.scalar(
+        select(PrivilegeDb).where(PrivilegeDb.username == username)
+    )
     if not privilege:
         raise HTTPException(status_code=404, detail="Privilege not found for this user")
 
-    history_entry = (
-        db.query(PrivilegeHistoryDb)
-        .filter(
+    history_entry = await db.scalar(
+        select(PrivilegeHistoryDb).where(
             PrivilegeHistoryDb.privilege_id == privilege.id,
             PrivilegeHistoryDb.ticket_uid == ticket_uid,
         )
-        .first()
     )
 
     if not history_entry:
         raise HTTPException(status_code=404, detail="History entry not found")
 
-    return history_entry
+    return WireResponse(PrivilegeHistory.model_validate(history_entry))
 
 
-@app.post("/privilege/{username}/history", status_code=201)
-def add_transaction(
-    username, data: AddTranscationRequest, db: Session = Depends(get_db)
-):
-    priv = db.query(PrivilegeDb).filter(PrivilegeDb.username == username).first()
-    if not priv:
-        raise HTTPException(status_code=404, detail="User not found")
+async def privilege_exists(db: AsyncSession, username: str) -> bool:
+    privilege_id = await db.scalar(
+        select(PrivilegeDb.id).where(PrivilegeDb.username == username)
+    )
+    return privilege_id is not None
 
-    if data.operation_type == "FILL_IN_BALANCE":
-        priv.balance += data.balance_diff
-    else:
-        if priv.balance < data.balance_diff:
-            raise HTTPException(status_code=409, detail="Can't decrease balance")
-        priv.balance -= data.balance_diff
 
-    hist = PrivilegeHistoryDb(
-        privilege_id=priv.id,
-        ticket_uid=data.ticket_uid,
-        datetime=data.datetime,
-        balance_diff=data.balance_diff,
-        operation_type=data.operation_type,
+def signed_diff(transaction) -> int:
+    if transaction.operation_type == "FILL_IN_BALANCE":
+        return transaction.balance_diff
+    return -transaction.balance_diff
+
+
+async def change_balance(db: AsyncSession, username: str, diff: int, required: int):
+    """
+    Adds diff to the balance with one conditional UPDATE ... RETURNING that
+    only matches while the balance is at least `required`, so concurrent
+    purchases cannot overdraw. Raises 404 or 409 when nothing matched.
+    """
+    balance = func.coalesce(PrivilegeDb.balance, 0)
+    result = await db.execute(
+        update(PrivilegeDb)
+        .where(PrivilegeDb.username == username, balance >= required)
+        .values(balance=balance + diff)
+        .returning(
+            PrivilegeDb.id,
+            PrivilegeDb.username,
+            PrivilegeDb.status,
+            PrivilegeDb.balance,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    priv = result.one_or_none()
+    if priv is None:
+        await db.rollback()
+        if not await privilege_exists(db, username):
+            raise HTTPException(status_code=404, detail="User not found")
+        raise HTTPException(status_code=409, detail="Can't decrease balance")
+    return priv
+
+
+async def revert_balance(db: AsyncSession, privilege_id: int, diff: int):
+    """
+    Takes back a balance change of diff, never going below zero.
+    """
+    balance = func.coalesce(PrivilegeDb.balance, 0)
+    await db.execute(
+        update(PrivilegeDb)
+        .where(PrivilegeDb.id == privilege_id)
+        .values(balance=case((balance - diff > 0, balance - diff), else_=0))
+        .execution_options(synchronize_session=False)
     )
-    db.add(hist)
 
-    db.commit()
-    db.refresh(priv)
 
+def history_row(privilege_id: int, transaction: AddTranscationRequest) -> dict:
+    return {
+        "privilege_id": privilege_id,
+        "ticket_uid": transaction.ticket_uid,
+        "datetime": transaction.datetime,
+        "balance_diff": transaction.balance_diff,
+        "operation_type": transaction.operation_type,
+    }
 
-@app.delete("/privilege/{username}/history/{ticket_uid}", status_code=204)
-def rollback_transaction(username, ticket_uid: uuid.UUID, db: Session = Depends(get_db)):
-    priv = db.query(PrivilegeDb).filter(PrivilegeDb.username == username).first()
-    if not priv:
-        raise HTTPException(status_code=404, detail="User not found")
 
-    transaction = (
-        db.query(PrivilegeHistoryDb)
-        .filter(
-            PrivilegeHistoryDb.privilege_id == priv.id,
-            PrivilegeHistoryDb.ticket_uid == ticket_uid,
+@app.post("/privilege/{username}/history", status_code=201, response_model=Privilege)
+async def add_transaction(
+    username, data: AddTranscationRequest, db: AsyncSession = Depends(get_db)
+):
+    """
+    Changes the balance and records the history entry in one transaction.
+    """
+    diff = signed_diff(data)
+    priv = await change_balance(db, username, diff, required=max(-diff, 0))
+    db.add(PrivilegeHistoryDb(**history_row(priv.id, data)))
+    await db.commit()
+    return Privilege.model_validate(priv)
+
+
+@app.post(
+    "/privilege/{username}/history/bulk", status_code=201, response_model=Privilege
+)
+async def add_transactions(
+    username, data: AddTransactionsRequest, db: AsyncSession = Depends(get_db)
+):
+    """
+    Applies a batch in one transaction: one UPDATE for the net balance change
+    and one multi-row INSERT for the history. Entries count in order, so the
+    balance has to cover the lowest point of their running total.
+    """
+    diff = 0
+    lowest = 0
+    for transaction in data.transactions:
+        diff += signed_diff(transaction)
+        lowest = min(lowest, diff)
+    priv = await change_balance(db, username, diff, required=-lowest)
+    await db.execute(
+        insert(PrivilegeHistoryDb).values(
+            [history_row(priv.id, t) for t in data.transactions]
         )
-        .first()
     )
-    if not transaction:
+    await db.commit()
+    return Privilege.model_validate(priv)
+
+
+def delete_history(username: str, ticket_uids):
+    privilege_id = (
+        select(PrivilegeDb.id).where(PrivilegeDb.username == username).scalar_subquery()
+    )
+    return (
+        delete(PrivilegeHistoryDb)
+        .where(
+            PrivilegeHistoryDb.privilege_id == privilege_id,
+            PrivilegeHistoryDb.ticket_uid.in_(ticket_uids),
+        )
+        .returning(
+            PrivilegeHistoryDb.privilege_id,
+            PrivilegeHistoryDb.operation_type,
+            PrivilegeHistoryDb.balance_diff,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+@app.delete("/privilege/{username}/history", status_code=204)
+async def rollback_transactions(
+    username,
+    ticket_uid: List[uuid.UUID] = Query(..., max_length=MAX_BULK_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Bulk counterpart of rollback_transaction. Entries that do not exist are
+    skipped.
+    """
+    transactions = (await db.execute(delete_history(username, ticket_uid))).all()
+    if not transactions:
+        await db.rollback()
+        if not await privilege_exists(db, username):
+            raise HTTPException(status_code=404, detail="User not found")
+        return
+    diff = sum(signed_diff(t) for t in transactions)
+    await revert_balance(db, transactions[0].privilege_id, diff)
+    await db.commit()
+
+
+@app.delete("/privilege/{username}/history/{ticket_uid}", status_code=204)
+async def rollback_transaction(
+    username, ticket_uid: uuid.UUID, db: AsyncSession = Depends(get_db)
+):
+    """
+    Deletes the history entry with DELETE ... RETURNING, so only one of
+    several concurrent rollbacks gets it, then reverts its balance change
+    with a single UPDATE.
+    """
+    transaction = (
+        await db.execute(delete_history(username, [ticket_uid]))
+    ).one_or_none()
+    if transaction is None:
+        await db.rollback()
+        if not await privilege_exists(db, username):
+            raise HTTPException(status_code=404, detail="User not found")
         raise HTTPException(status_code=404, detail="Transaction not found")
 
-    cur_balance = priv.balance
-    if transaction.operation_type == "FILL_IN_BALANCE":
-        new_balance = max(cur_balance - transaction.balance_diff, 0)
-    else:
-        new_balance = cur_balance + transaction.balance_diff
-    priv.balance = new_balance
-    db.delete(transaction)
-    db.commit()
-    db.refresh(priv)
+    await revert_balance(db, transaction.privilege_id, signed_diff(transaction))
+    await db.commit()
 
 
 @app.get("/manage/health", status_code=201)
-def health():
+async def health():
     pass
+
+
+@app.get("/manage/metrics")
+async def metrics():
+    return {
+        "inflight": inflight.stats(),
+        "threadpool": threadpool_stats(),
+        "db": pool_metrics.stats(),
+    }
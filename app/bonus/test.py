@@ -1,23 +1,38 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from uuid import uuid4
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import NullPool, func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 import os
 
 os.environ["TESTING"] = "True"
 
 from main import app, get_db, Base, PrivilegeDb, PrivilegeHistoryDb, engine
+from common import PrivilegeHistory
+from dbtesting import assert_uses_indexes, count_queries
 
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestingSessionLocal = async_sessionmaker(
+    engine, autoflush=False, expire_on_commit=False
+)
+run = asyncio.run
 
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def drop_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 app.dependency_overrides[get_db] = override_get_db
@@ -29,28 +44,28 @@ def db_session():
     Creates a new database session for a test, using the same engine as the app.
     """
     # Create tables
-    Base.metadata.create_all(bind=engine)
+    run(create_tables())
 
     session = TestingSessionLocal()
     try:
         yield session
     finally:
-        session.close()
-        Base.metadata.drop_all(bind=engine)
+        run(session.close())
+        run(drop_tables())
 
 
 @pytest.fixture
 def client():
-    Base.metadata.create_all(bind=engine)
+    run(create_tables())
     yield TestClient(app)
-    Base.metadata.drop_all(bind=engine)
+    run(drop_tables())
 
 
 @pytest.fixture
 def sample_privilege(db_session):
     privilege = PrivilegeDb(username="api_user", status="BRONZE", balance=100)
     db_session.add(privilege)
-    db_session.commit()
+    run(db_session.commit())
 
     history = PrivilegeHistoryDb(
         privilege_id=privilege.id,
@@ -60,7 +75,7 @@ def sample_privilege(db_session):
         operation_type="FILL_IN_BALANCE",
     )
     db_session.add(history)
-    db_session.commit()
+    run(db_session.commit())
 
     return privilege, history
 
@@ -105,6 +120,74 @@ def test_get_privilege_history_list(client, sample_privilege):
     assert data[0]["balance_diff"] == 100
 
 
+# ----------------------------------------------------------------
+# GET /privilege/{username}/summary
+# ----------------------------------------------------------------
+
+
+def test_get_privilege_summary_pages(client, db_session, sample_privilege):
+    privilege, first = sample_privilege
+    for day in range(1, 5):
+        db_session.add(
+            PrivilegeHistoryDb(
+                privilege_id=privilege.id,
+                ticket_uid=uuid4(),
+                datetime=datetime(2030, 1, day),
+                balance_diff=day,
+                operation_type="FILL_IN_BALANCE",
+            )
+        )
+    run(db_session.commit())
+    username = privilege.username
+
+    with count_queries(engine) as queries:
+        response = client.get(f"/privilege/{username}/summary", params={"limit": 2})
+    assert response.status_code == 200
+    assert len(queries) == 1
+
+    data = response.json()
+    assert data["balance"] == 100
+    assert data["status"] == "BRONZE"
+    assert [h["balance_diff"] for h in data["history"]] == [4, 3]
+
+    seen = []
+    cursor = data["nextCursor"]
+    while cursor:
+        data = client.get(
+            f"/privilege/{username}/summary",
+            params={"limit": 2, "cursor": cursor},
+        ).json()
+        seen += [h["balance_diff"] for h in data["history"]]
+        cursor = data["nextCursor"]
+    assert seen == [2, 1, 100]
+
+    # without a limit the whole history comes back
+    data = client.get(f"/privilege/{username}/summary").json()
+    assert [h["balance_diff"] for h in data["history"]] == [4, 3, 2, 1, 100]
+    assert data["nextCursor"] is None
+
+
+def test_get_privilege_summary_empty_history(client, db_session):
+    db_session.add(PrivilegeDb(username="new_user", status="BRONZE", balance=0))
+    run(db_session.commit())
+
+    response = client.get("/privilege/new_user/summary")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["history"] == []
+    assert data["nextCursor"] is None
+
+
+def test_get_privilege_summary_errors(client, sample_privilege):
+    privilege, _ = sample_privilege
+    response = client.get("/privilege/unknown_user/summary")
+    assert response.status_code == 404
+    response = client.get(
+        f"/privilege/{privilege.username}/summary", params={"cursor": "garbage"}
+    )
+    assert response.status_code == 400
+
+
 # ----------------------------------------------------------------
 # GET /privilege/{username}/history/{ticket_uid}
 # ----------------------------------------------------------------
@@ -148,6 +231,8 @@ def test_create_privilege_history(client, sample_privilege):
 
     response = client.post(f"/privilege/{privilege.username}/history", json=payload)
     assert response.status_code == 201
+    assert response.json()["balance"] == 50
+    assert response.json()["status"] == "BRONZE"
 
     # Verify new balance updated in privilege if applicable
     check_privilege = client.get(f"/privilege/{privilege.username}")
@@ -192,5 +277,212 @@ def test_delete_nonexistent_history(client, sample_privilege):
     assert response.status_code == 404
 
 
+def test_export_history(client, db_session, sample_privilege):
+    privilege, _ = sample_privilege
+    start = datetime(2021, 1, 1)
+    db_session.add_all(
+        PrivilegeHistoryDb(
+            privilege_id=privilege.id,
+            ticket_uid=uuid4(),
+            datetime=start + timedelta(minutes=i),
+            balance_diff=i,
+            operation_type="FILL_IN_BALANCE",
+        )
+        for i in range(1200)
+    )
+    run(db_session.commit())
+
+    with client.stream("GET", f"/privilege/{privilege.username}/history/export") as r:
+        assert r.status_code == 200
+        assert r.headers["content-type"] == "application/x-ndjson"
+        chunks = list(r.iter_bytes())
+    lines = b"".join(chunks).decode().splitlines()
+    assert len(lines) == 1201
+    entries = [PrivilegeHistory.model_validate_json(line) for line in lines]
+    assert [e.balance_diff for e in entries[1:4]] == [1199, 1198, 1197]
+
+    response = client.get("/privilege/nobody/history/export")
+    assert response.status_code == 404
+
+
+def transaction(privilege_id, operation_type, balance_diff, ticket_uid=None):
+    return {
+        "ticket_uid": str(ticket_uid or uuid4()),
+        "balance_diff": balance_diff,
+        "operation_type": operation_type,
+        "privilege_id": privilege_id,
+        "datetime": datetime.now().isoformat(),
+    }
+
+
+def test_transaction_statements(client, sample_privilege):
+    privilege, history = sample_privilege
+    url = f"/privilege/{privilege.username}/history"
+
+    with count_queries(engine) as queries:
+        response = client.post(
+            url, json=transaction(privilege.id, "FILL_IN_BALANCE", 10)
+        )
+    assert response.status_code == 201
+    assert response.json()["balance"] == 110
+    statements = [statement.split()[0] for statement, _ in queries]
+    assert statements == ["UPDATE", "INSERT"]
+
+    response = client.post(
+        url, json=transaction(privilege.id, "DEBIT_THE_ACCOUNT", 111)
+    )
+    assert response.status_code == 409
+    response = client.post(
+        "/privilege/nobody/history",
+        json=transaction(privilege.id, "DEBIT_THE_ACCOUNT", 1),
+    )
+    assert response.status_code == 404
+
+    with count_queries(engine) as queries:
+        response = client.delete(f"{url}/{history.ticket_uid}")
+    assert response.status_code == 204
+    statements = [statement.split()[0] for statement, _ in queries]
+    assert statements == ["DELETE", "UPDATE"]
+    assert client.get(f"/privilege/{privilege.username}").json()["balance"] == 10
+
+
+def test_bulk_transactions(client, sample_privilege):
+    privilege, history = sample_privilege
+    url = f"/privilege/{privilege.username}/history"
+    batch = [
+        transaction(privilege.id, "DEBIT_THE_ACCOUNT", 100),
+        transaction(privilege.id, "FILL_IN_BALANCE", 50),
+        transaction(privilege.id, "DEBIT_THE_ACCOUNT", 50),
+    ]
+
+    # the running total dips below zero before the fill arrives
+    overdraw = [batch[1], batch[0], batch[2], batch[2]]
+    response = client.post(f"{url}/bulk", json={"transactions": overdraw})
+    assert response.status_code == 409
+
+    with count_queries(engine) as queries:
+        response = client.post(f"{url}/bulk", json={"transactions": batch})
+    assert response.status_code == 201
+    assert response.json()["balance"] == 0
+    assert [q.split()[0] for q, _ in queries] == ["UPDATE", "INSERT"]
+    assert len(client.get(url).json()) == 4
+
+    with count_queries(engine) as queries:
+        response = client.delete(
+            url,
+            params={"ticket_uid": [t["ticket_uid"] for t in batch] + [str(uuid4())]},
+        )
+    assert response.status_code == 204
+    assert [q.split()[0] for q, _ in queries] == ["DELETE", "UPDATE"]
+    assert client.get(f"/privilege/{privilege.username}").json()["balance"] == 100
+    assert len(client.get(url).json()) == 1
+
+    response = client.delete(
+        "/privilege/nobody/history", params={"ticket_uid": [str(uuid4())]}
+    )
+    assert response.status_code == 404
+
+
+@pytest.fixture
+def file_db(tmp_path):
+    """
+    Points the app at a file database with a connection per session, so
+    requests from several threads really run concurrently.
+    """
+    file_engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path}/bonus.db", poolclass=NullPool
+    )
+
+    async def create():
+        async with file_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    run(create())
+    sessions = async_sessionmaker(file_engine, expire_on_commit=False)
+
+    async def get_file_db():
+        async with sessions() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = get_file_db
+    yield sessions
+    app.dependency_overrides[get_db] = override_get_db
+    run(file_engine.dispose())
+
+
+def test_concurrent_transactions_keep_ledger_consistent(file_db):
+    async def seed():
+        async with file_db() as db:
+            privilege = PrivilegeDb(username="moose", status="BRONZE", balance=100)
+            db.add(privilege)
+            await db.commit()
+            return privilege.id
+
+    async def ledger():
+        async with file_db() as db:
+            balance = await db.scalar(select(PrivilegeDb.balance))
+            history = (
+                await db.execute(
+                    select(
+                        PrivilegeHistoryDb.operation_type,
+                        PrivilegeHistoryDb.balance_diff,
+                    )
+                )
+            ).all()
+            filled = sum(d for op, d in history if op == "FILL_IN_BALANCE")
+            debited = sum(d for op, d in history if op == "DEBIT_THE_ACCOUNT")
+            return balance, filled, debited
+
+    privilege_id = run(seed())
+    client = TestClient(app)
+    url = "/privilege/moose/history"
+    fills = [transaction(privilege_id, "FILL_IN_BALANCE", 10) for _ in range(40)]
+    debits = [transaction(privilege_id, "DEBIT_THE_ACCOUNT", 30) for _ in range(40)]
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        statuses = list(
+            pool.map(
+                lambda body: client.post(url, json=body).status_code, fills + debits
+            )
+        )
+    assert statuses[:40] == [201] * 40
+    assert set(statuses[40:]) <= {201, 409}
+    debited = [d for d, status in zip(debits, statuses[40:]) if status == 201]
+
+    balance, filled_total, debited_total = run(ledger())
+    assert filled_total == 400
+    assert debited_total == 30 * len(debited)
+    assert balance == 100 + filled_total - debited_total
+    assert balance >= 0
+
+    # every successful debit is rolled back by several threads at once
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        rollbacks = list(
+            pool.map(
+                lambda body: client.delete(f"{url}/{body['ticket_uid']}").status_code,
+                [body for body in debited for _ in range(4)],
+            )
+        )
+    assert rollbacks.count(204) == len(debited)
+    assert rollbacks.count(404) == 3 * len(debited)
+    assert run(ledger()) == (500, 400, 0)
+
+
+def test_privilege_queries_use_indexes(client, sample_privilege):
+    privilege, history = sample_privilege
+    username, ticket_uid = privilege.username, history.ticket_uid
+
+    for method, url in [
+        ("GET", f"/privilege/{username}"),
+        ("GET", f"/privilege/{username}/summary"),
+        ("GET", f"/privilege/{username}/history"),
+        ("GET", f"/privilege/{username}/history/{ticket_uid}"),
+        ("DELETE", f"/privilege/{username}/history/{ticket_uid}"),
+    ]:
+        with count_queries(engine) as queries:
+            assert client.request(method, url).status_code < 300
+        assert_uses_indexes(engine, queries)
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -1,11 +1,31 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
 import uuid
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import datetime
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List
 from datetime import datetime
 from enum import Enum
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class Ticket(BaseModel):
@@ -59,6 +79,15 @@ class PrivilegeHistory(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 
+class PrivilegeSummary(BaseModel):
+    id: int
+    username: str
+    status: str
+    balance: int
+    history: List[PrivilegeHistory]
+    nextCursor: Optional[str] = None
+
+
 # -------------------- ENUMS --------------------
 
 
@@ -96,6 +125,9 @@ class PaginationResponse(BaseModel):
     pageSize: int = Field(..., description="Количество элементов на странице")
     totalElements: int = Field(..., description="Общее количество элементов")
     items: List[FlightResponse] = Field(..., description="Список рейсов")
+    nextCursor: Optional[str] = Field(
+        None, description="Курсор следующей страницы (только в режиме курсора)"
+    )
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -134,6 +166,9 @@ class PrivilegeInfoResponse(BaseModel):
     balance: int = Field(..., description="Баланс бонусного счета")
     status: PrivilegeStatus = Field(..., description="Статус в бонусной программе")
     history: List[BalanceHistory] = Field(..., description="История изменения баланса")
+    nextCursor: Optional[str] = Field(
+        None, description="Курсор следующей страницы истории"
+    )
 
 
 class UserInfoResponse(BaseModel):
@@ -200,3 +235,518 @@ class AddTranscationRequest(BaseModel):
     datetime: datetime
     balance_diff: int
     operation_type: str
+
+
+# -------------------- BULK --------------------
+
+MAX_BULK_SIZE = 100
+
+
+class TicketBulkCreateRequest(BaseModel):
+    tickets: List[TicketCreateRequest] = Field(
+        ..., min_length=1, max_length=MAX_BULK_SIZE, description="Создаваемые билеты"
+    )
+
+
+class AddTransactionsRequest(BaseModel):
+    transactions: List[AddTranscationRequest] = Field(
+        ..., min_length=1, max_length=MAX_BULK_SIZE
+    )
+
+
+class BulkTicketPurchaseRequest(BaseModel):
+    tickets: List[TicketPurchaseRequest] = Field(
+        ..., min_length=1, max_length=MAX_BULK_SIZE, description="Покупаемые билеты"
+    )
+
+
+class BulkTicketPurchaseResponse(BaseModel):
+    tickets: List[TicketPurchaseResponse] = Field(..., description="Купленные билеты")
+    privilege: PrivilegeShortInfo = Field(
+        ..., description="Информация о бонусной программе"
+    )
+
+
+# -------------------- PAGINATION --------------------
+
+
+# Carries the cursor of the next page when the body is a plain list
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(*values) -> str:
+    """
+    Packs the sort key of the last returned row into an opaque cursor.
+    """
+    raw = json.dumps(values, default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    """
+    Reverses encode_cursor, raising ValueError for malformed cursors.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+# -------------------- FAST JSON --------------------
+
+
+def _json_default(obj):
+    if isinstance(obj, BaseModel):
+        # The models here have no aliases or custom serializers
+        return obj.__dict__
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def json_dumps(content) -> bytes:
+    """
+    Encodes with orjson when it is installed, else with the json module.
+    """
+    if orjson is not None:
+        # UTC as "Z", the way pydantic writes it
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_UTC_Z)
+    return json.dumps(
+        content, default=_json_default, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+def json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response encoded by json_dumps().
+
+    An endpoint returning it bypasses FastAPI's response_model validation and
+    serialization, so the content must already have the documented shape.
+    """
+
+    def render(self, content) -> bytes:
+        return json_dumps(content)
+
+
+# -------------------- WIRE FORMAT --------------------
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# Accept header of the request being handled
+accept_var: ContextVar[str | None] = ContextVar("accept", default=None)
+
+
+def _media_quality(accept: str, media_type: str) -> float:
+    for item in accept.split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        if name.lower() != media_type:
+            continue
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    return float(value)
+                except ValueError:
+                    return 0.0
+        return 1.0
+    return 0.0
+
+
+def wants_msgpack(accept: str | None = None) -> bool:
+    """
+    Whether the current request, or the given Accept header, prefers
+    MessagePack to JSON. Without the msgpack package it never does.
+    """
+    accept = accept if accept is not None else accept_var.get()
+    if msgpack is None or not accept:
+        return False
+    quality = _media_quality(accept, MSGPACK_MEDIA_TYPE)
+    return quality > 0 and quality >= _media_quality(accept, "application/json")
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.__dict__
+    if isinstance(obj, uuid.UUID):
+        return obj.bytes
+    if isinstance(obj, datetime):
+        # Aware datetimes are packed as Timestamps; naive ones keep ISO 8601
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+
+def msgpack_dumps(content) -> bytes:
+    return msgpack.packb(content, default=_msgpack_default, datetime=True)
+
+
+def msgpack_loads(data):
+    """
+    Decodes MessagePack written by msgpack_dumps. UUIDs come back as 16
+    bytes and aware datetimes in UTC, both of which pydantic accepts.
+    """
+    return msgpack.unpackb(data, timestamp=3)
+
+
+class WireResponse(FastJSONResponse):
+    """
+    FastJSONResponse that is encoded as MessagePack instead when the request
+    prefers it. Backends return it from the endpoints the gateway calls.
+    """
+
+    def __init__(self, content, *args, **kwargs):
+        self.binary = wants_msgpack()
+        if self.binary:
+            self.media_type = MSGPACK_MEDIA_TYPE
+        super().__init__(content, *args, **kwargs)
+        self.headers["Vary"] = "Accept"
+
+    def render(self, content) -> bytes:
+        return msgpack_dumps(content) if self.binary else super().render(content)
+
+
+# -------------------- STREAMING --------------------
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Rows fetched per round trip of a server-side cursor
+EXPORT_BATCH_SIZE = 500
+
+
+async def ndjson_stream(result):
+    """
+    Renders a streamed query result as NDJSON, one chunk per fetched batch,
+    so only a single batch of rows is held in memory at a time.
+    """
+    async for rows in result.partitions():
+        yield b"".join(json_dumps(row._asdict()) + b"\n" for row in rows)
+
+
+# -------------------- CONDITIONAL REQUESTS --------------------
+
+
+def make_etag(*parts: bytes) -> str:
+    """
+    Strong ETag derived from the given bytes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part)
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Whether an If-None-Match header lists the ETag. The comparison is weak,
+    as RFC 9110 requires for If-None-Match.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
+    )
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    """
+    304 for a WireResponse, carrying the same Vary as the 200 would so that
+    shared caches keep the JSON and MessagePack copies apart.
+    """
+    return Response(
+        status_code=304,
+        headers={"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept"},
+    )
+
+
+# -------------------- METRICS --------------------
+
+# Seconds; the default buckets of the Prometheus client libraries
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Bytes
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, le=None) -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, labels)} {value:g}"
+            )
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus histogram. Bucket counts are kept per bucket and only made
+    cumulative when rendered, so observe() is a bisect and two additions.
+    """
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts + overflow, sum]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, le=bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {total:g}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Counter | Histogram] = {}
+
+    def _register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(
+        self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ("method", "route"),
+)
+requests_total = registry.counter(
+    "http_requests_total", "Handled HTTP requests", ("method", "route", "status")
+)
+response_size = registry.histogram(
+    "http_response_size_bytes",
+    "Size of HTTP response bodies",
+    ("method", "route"),
+    buckets=SIZE_BUCKETS,
+)
+
+
+class PrometheusMiddleware:
+    """
+    Records latency, status code and body size of every HTTP request, labelled
+    by the route template so path parameters do not multiply the series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", "<unmatched>")
+            method = scope["method"]
+            request_duration.observe(time.perf_counter() - start, method, route)
+            requests_total.inc(method, route, status)
+            response_size.observe(size, method, route)
+
+
+# -------------------- REQUEST CONTEXT --------------------
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+# Server-Timing entries of the current request, name -> seconds
+_timings_var: ContextVar[dict | None] = ContextVar("server_timing", default=None)
+
+access_logger = logging.getLogger("app.access")
+ACCESS_LOG_LEVEL = os.getenv("ACCESS_LOG_LEVEL", "INFO")
+
+
+def configure_access_log():
+    """
+    uvicorn configures only its own loggers, which would leave the access
+    log at the root's WARNING level with nowhere to go.
+    """
+    access_logger.setLevel(ACCESS_LOG_LEVEL)
+    if not access_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s")
+        )
+        access_logger.addHandler(handler)
+
+
+def add_server_timing(name: str, seconds: float):
+    """
+    Adds time to a Server-Timing entry of the request being handled.
+    Outside a request this does nothing.
+    """
+    timings = _timings_var.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def format_server_timing(timings: dict) -> str:
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()
+    )
+
+
+def parse_server_timing(header: str) -> dict[str, float]:
+    """
+    Reads the durations of a Server-Timing header back into seconds.
+    """
+    timings = {}
+    for entry in header.split(","):
+        name, *params = [part.strip() for part in entry.split(";")]
+        for param in params:
+            key, _, value = param.partition("=")
+            if name and key == "dur":
+                try:
+                    timings[name] = float(value) / 1000
+                except ValueError:
+                    pass
+    return timings
+
+
+class RequestContextMiddleware:
+    """
+    Accepts the caller's X-Request-ID or generates one, echoes it back and
+    appends the Server-Timing entries collected through add_server_timing.
+    Every request is logged with its ID and timings. The Accept header is
+    kept in accept_var for WireResponse.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        header = REQUEST_ID_HEADER.lower().encode()
+        request_id = accept = None
+        for key, value in scope["headers"]:
+            if key == header:
+                request_id = value.decode("latin-1")
+            elif key == b"accept":
+                accept = value.decode("latin-1")
+        request_id = request_id or uuid.uuid4().hex
+        timings = {}
+        id_token = request_id_var.set(request_id)
+        timings_token = _timings_var.set(timings)
+        accept_token = accept_var.set(accept)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((header, request_id.encode("latin-1")))
+                if timings:
+                    headers.append(
+                        (b"server-timing", format_server_timing(timings).encode())
+                    )
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(id_token)
+            _timings_var.reset(timings_token)
+            accept_var.reset(accept_token)
+            access_logger.info(
+                "%s %s %s %s %.1fms %s",
+                request_id,
+                scope["method"],
+                scope["path"],
+                status,
+                (time.perf_counter() - start) * 1000,
+                format_server_timing(timings),
+            )
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def instrument(app, path: str = "/manage/metrics/prometheus"):
+    """
+    Mounts the Prometheus and request context middlewares on a FastAPI app,
+    sets up the access log and serves the registry.
+    """
+    app.add_middleware(PrometheusMiddleware)
+    app.add_middleware(RequestContextMiddleware)
+    configure_access_log()
+
+    @app.get(path, include_in_schema=False)
+    async def prometheus_metrics():
+        return Response(registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,52 @@
+"""
+Query inspection helpers shared by the app/<service>/test.py suites.
+
+    with count_queries(engine) as queries:
+        client.get("/tickets/user/moose")
+    assert_uses_indexes(engine, queries)
+"""
+
+import asyncio
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+@contextmanager
+def count_queries(engine: AsyncEngine):
+    """
+    Collects the (statement, parameters) of every query the engine runs.
+    """
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        queries.append((statement, parameters))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+def assert_uses_indexes(engine: AsyncEngine, queries):
+    """
+    Fails if SQLite plans a full table scan for any of the captured queries.
+    """
+    assert queries
+
+    async def explain(statement, parameters):
+        async with engine.connect() as conn:
+            result = await conn.exec_driver_sql(
+                f"EXPLAIN QUERY PLAN {statement}", parameters
+            )
+            return [row[-1] for row in result.all()]
+
+    for statement, parameters in queries:
+        details = asyncio.run(explain(statement, parameters))
+        assert not any(re.fullmatch(r"SCAN \w+", detail) for detail in details), (
+            statement,
+            details,
+        )
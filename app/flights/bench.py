@@ -0,0 +1,51 @@
+"""
+Microbenchmarks of the flights service hot paths. See app/benchmark.py.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+import os
+
+os.environ.setdefault("TESTING", "True")
+
+from main import FlightCatalog, flight_to_response
+from common import PaginationResponse
+from benchmark import main
+
+# Same columns as select_flights()
+FlightRow = namedtuple(
+    "FlightRow",
+    "id flight_number datetime price from_city from_name to_city to_name",
+)
+
+START = datetime(2021, 10, 8, 20, 0, tzinfo=timezone.utc)
+ROWS = [
+    FlightRow(
+        i,
+        f"AFL{i:04d}",
+        START + timedelta(hours=i),
+        1500 + i % 500,
+        "Санкт-Петербург",
+        "Пулково",
+        "Москва",
+        "Шереметьево",
+    )
+    for i in range(1, 10_001)
+]
+PAGE = [flight_to_response(row) for row in ROWS[:100]]
+
+
+BENCHMARKS = {
+    "flight_to_response x1000": lambda: [flight_to_response(r) for r in ROWS[:1000]],
+    "PaginationResponse 100 items": lambda: PaginationResponse(
+        page=1, pageSize=100, totalElements=len(ROWS), items=PAGE
+    ),
+    "PaginationResponse 100 items dump": lambda: PaginationResponse(
+        page=1, pageSize=100, totalElements=len(ROWS), items=PAGE
+    ).model_dump_json(),
+    "FlightCatalog 10000 rows": lambda: FlightCatalog(ROWS),
+}
+
+
+if __name__ == "__main__":
+    main(BENCHMARKS)
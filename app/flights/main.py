@@ -1,18 +1,33 @@
 import inspect
 import sys
-from fastapi import FastAPI, HTTPException, Depends, Query
-from sqlalchemy import create_engine, Column, Integer, String
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
+from bisect import bisect_right
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Header, Query
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import declarative_base
 from sqlalchemy import Column, Integer, String, ForeignKey, TIMESTAMP, StaticPool
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy import Index, and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import relationship, declarative_base, aliased
 from datetime import datetime
+import asyncio
+import logging
 import os
+import time
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 
 from common import *
+from migrations import Migration, create_indexes, migrate
+from metrics import (
+    InFlight,
+    InFlightMiddleware,
+    PoolMetrics,
+    threadpool_stats,
+    track_db_time,
+)
 
 if not os.getenv("TESTING"):
     # Database configuration from environment variables
@@ -21,34 +36,82 @@ if not os.getenv("TESTING"):
     DB_NAME = os.getenv("POSTGRES_DB", "postgres")
     DB_HOST = os.getenv("DB_HOST", "postgres")
     DB_PORT = os.getenv("DB_PORT", "5432")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
 
-    DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    DATABASE_URL = (
+        f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    )
 
     # SQLAlchemy setup
-    engine = create_engine(DATABASE_URL)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine = create_async_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+    SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
     Base = declarative_base()
 else:
     # For tests, create minimal setup
     Base = declarative_base()
 
-    SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+    SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
 
-    engine = create_engine(
+    engine = create_async_engine(
         SQLALCHEMY_DATABASE_URL,
-        connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
+    SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+RUN_MIGRATIONS = (
+    os.getenv("RUN_MIGRATIONS", "0" if os.getenv("TESTING") else "1") == "1"
+)
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 100
+FLIGHTS_COUNT_TTL = float(os.getenv("FLIGHTS_COUNT_TTL", "60"))
+# Serve flights from an in-memory snapshot instead of the database
+FLIGHTS_SNAPSHOT = os.getenv("FLIGHTS_SNAPSHOT", "0") == "1"
+FLIGHTS_SNAPSHOT_INTERVAL = float(os.getenv("FLIGHTS_SNAPSHOT_INTERVAL", "300"))
+# Clients may keep flight responses but must revalidate them with their ETag
+FLIGHTS_CACHE_CONTROL = os.getenv("FLIGHTS_CACHE_CONTROL", "no-cache")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if RUN_MIGRATIONS:
+        await migrate(engine, MIGRATIONS)
+    refresher = None
+    if FLIGHTS_SNAPSHOT:
+        await refresh_catalog()
+        refresher = asyncio.create_task(refresh_catalog_periodically())
+    try:
+        yield
+    finally:
+        if refresher is not None:
+            refresher.cancel()
 
-app = FastAPI(title="Flight API")
 
+app = FastAPI(title="Flight API", lifespan=lifespan)
+inflight = InFlight()
+app.add_middleware(InFlightMiddleware, inflight=inflight)
+instrument(app)
+pool_metrics = PoolMetrics(engine)
+track_db_time(engine)
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+async def get_db():
+    async with SessionLocal() as db:
+        # Reads served from the snapshot never use the session, so they must
+        # not hold a pooled connection either
+        if catalog is None:
+            await pool_metrics.checkout(db)
         yield db
-    finally:
-        db.close()
 
 
 class AirportDb(Base):
@@ -88,53 +151,328 @@ class FlightDb(Base):
         "AirportDb", foreign_keys=[to_airport_id], back_populates="arrivals"
     )
 
+    __table_args__ = (
+        Index("ix_flight_flight_number", "flight_number"),
+        Index("ix_flight_datetime_id", "datetime", "id"),
+    )
+
+
+MIGRATIONS = [
+    Migration(
+        1,
+        "flight lookup indexes",
+        create_indexes(FlightDb, "ix_flight_flight_number", "ix_flight_datetime_id"),
+    ),
+]
+
+
+class CachedCount:
+    """
+    Row count recomputed at most once every `ttl` seconds instead of per request.
+    """
+
+    def __init__(self, count, ttl: float):
+        self.count = count
+        self.ttl = ttl
+        self.value = None
+        self.expires_at = 0.0
+
+    async def get(self, db: AsyncSession) -> int:
+        if self.value is None or self.expires_at <= time.monotonic():
+            self.value = await db.scalar(self.count)
+            self.expires_at = time.monotonic() + self.ttl
+        return self.value
+
+    def invalidate(self):
+        self.value = None
+
+
+flights_count = CachedCount(
+    select(func.count()).select_from(FlightDb), FLIGHTS_COUNT_TTL
+)
+
+FromAirportDb = aliased(AirportDb)
+ToAirportDb = aliased(AirportDb)
+
+
+def select_flights():
+    """
+    Flights together with both airports in one joined SELECT.
+
+    Rows are plain tuples consumed by flight_to_response, so no lazy
+    relationship loads happen while rendering.
+    """
+    return (
+        select(
+            FlightDb.id,
+            FlightDb.flight_number,
+            FlightDb.datetime,
+            FlightDb.price,
+            FromAirportDb.city.label("from_city"),
+            FromAirportDb.name.label("from_name"),
+            ToAirportDb.city.label("to_city"),
+            ToAirportDb.name.label("to_name"),
+        )
+        .join(FromAirportDb, FlightDb.from_airport_id == FromAirportDb.id)
+        .join(ToAirportDb, FlightDb.to_airport_id == ToAirportDb.id)
+    )
 
-def flight_to_response(flight: FlightDb) -> FlightResponse:
-    from_airport = f"{flight.from_airport.city} {flight.from_airport.name}"
-    to_airport = f"{flight.to_airport.city} {flight.to_airport.name}"
 
+def flight_to_response(row) -> FlightResponse:
     return FlightResponse(
-        flightNumber=flight.flight_number,
-        fromAirport=from_airport,
-        toAirport=to_airport,
-        date=flight.datetime.isoformat(),
-        price=flight.price,
+        flightNumber=row.flight_number,
+        fromAirport=f"{row.from_city} {row.from_name}",
+        toAirport=f"{row.to_city} {row.to_name}",
+        date=row.datetime,
+        price=row.price,
     )
 
 
+class FlightCatalog:
+    """
+    Immutable in-memory copy of all flights and their airports.
+
+    Prebuilt responses are indexed by flight number, by id for offset pages
+    and by (datetime, id) for cursor pages. A refresh builds a new catalog
+    in a worker thread and then swaps the module-level reference, so readers
+    keep being served from the old one meanwhile.
+    """
+
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda r: r.id)
+        self.by_id = [flight_to_response(r) for r in rows]
+        self.by_number = {}
+        for row, flight in zip(rows, self.by_id):
+            self.by_number.setdefault(row.flight_number, flight)
+
+        order = sorted(range(len(rows)), key=lambda i: (rows[i].datetime, rows[i].id))
+        self.departure_keys = [(rows[i].datetime, rows[i].id) for i in order]
+        self.by_departure = [self.by_id[i] for i in order]
+        self.fingerprint = make_etag(json_dumps(self.by_id)).encode()
+        self.loaded_at = datetime.now()
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def etag(self, *key) -> str:
+        """
+        ETag of the response for the request identified by `key`, known
+        without rendering it: the same flights give the same responses.
+        """
+        # JSON and MessagePack bodies are different representations
+        return make_etag(self.fingerprint, repr((wants_msgpack(), *key)).encode())
+
+    def page(self, page: int, page_size: int) -> list[FlightResponse]:
+        offset = (page - 1) * page_size
+        return self.by_id[offset : offset + page_size]
+
+    def seek(self, after, page_size: int):
+        """
+        Up to page_size flights departing after the `after` key, plus the key
+        of the last returned flight if more follow.
+        """
+        start = bisect_right(self.departure_keys, after) if after else 0
+        end = start + page_size
+        last_key = self.departure_keys[end - 1] if end < len(self) else None
+        return self.by_departure[start:end], last_key
+
+
+catalog: FlightCatalog | None = None
+
+
+async def refresh_catalog() -> FlightCatalog:
+    global catalog
+    async with SessionLocal() as db:
+        rows = (await db.execute(select_flights())).all()
+    # Sorting and rendering every flight would stall the event loop
+    fresh = await asyncio.to_thread(FlightCatalog, rows)
+    catalog = fresh
+    return fresh
+
+
+async def refresh_catalog_periodically():
+    while True:
+        await asyncio.sleep(FLIGHTS_SNAPSHOT_INTERVAL)
+        try:
+            await refresh_catalog()
+        except Exception:
+            logger.exception("Flight catalog refresh failed, keeping the old one")
+
+
+def cached_response(content, if_none_match: str | None, etag: str | None = None):
+    """
+    `content` with its ETag and Cache-Control, or 304 when the client's copy
+    is current. A precomputed ETag lets a 304 skip rendering the body;
+    otherwise the body is rendered and hashed.
+    """
+    if etag is not None and etag_matches(if_none_match, etag):
+        return not_modified(etag, FLIGHTS_CACHE_CONTROL)
+    response = WireResponse(content, headers={"Cache-Control": FLIGHTS_CACHE_CONTROL})
+    if etag is None:
+        etag = make_etag(response.body)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag, FLIGHTS_CACHE_CONTROL)
+    response.headers["ETag"] = etag
+    return response
+
+
+def parse_flight_cursor(cursor: str):
+    try:
+        cursor_datetime, cursor_id = decode_cursor(cursor)
+        return datetime.fromisoformat(cursor_datetime), int(cursor_id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @app.get("/flights", response_model=PaginationResponse)
-def get_all_flights(
+async def get_all_flights(
     page: int = Query(1, ge=1, description="Номер страницы"),
     page_size: int = Query(
         10, ge=1, le=100, description="Количество элементов на странице"
     ),
-    db: Session = Depends(get_db),
+    cursor: Optional[str] = Query(
+        None, description="Курсор страницы, пустая строка для первой страницы"
+    ),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
 ):
-    offset = (page - 1) * page_size
+    after = parse_flight_cursor(cursor) if cursor else None
+    snapshot = catalog
+    etag = None
+
+    if snapshot is not None:
+        etag = snapshot.etag("flights", page, page_size, cursor)
+        total = len(snapshot)
+        if cursor is None:
+            items, last_key = snapshot.page(page, page_size), None
+        else:
+            items, last_key = snapshot.seek(after, page_size)
+    elif cursor is None:
+        total = await flights_count.get(db)
+        offset = (page - 1) * page_size
+        flights = await db.execute(
+            select_flights().order_by(FlightDb.id).offset(offset).limit(page_size)
+        )
+        items, last_key = [flight_to_response(f) for f in flights], None
+    else:
+        # Keyset mode: seek past the last (datetime, id) instead of scanning OFFSET rows
+        total = await flights_count.get(db)
+        query = select_flights()
+        if after:
+            cursor_datetime, cursor_id = after
+            query = query.where(
+                or_(
+                    FlightDb.datetime > cursor_datetime,
+                    and_(FlightDb.datetime == cursor_datetime, FlightDb.id > cursor_id),
+                )
+            )
+        flights = (
+            await db.execute(
+                query.order_by(FlightDb.datetime, FlightDb.id).limit(page_size + 1)
+            )
+        ).all()
+        last_key = None
+        if len(flights) > page_size:
+            flights = flights[:page_size]
+            last_key = (flights[-1].datetime, flights[-1].id)
+        items = [flight_to_response(f) for f in flights]
+
+    next_cursor = None
+    if last_key is not None:
+        next_cursor = encode_cursor(last_key[0].isoformat(), last_key[1])
+
+    return cached_response(
+        PaginationResponse(
+            page=page,
+            pageSize=page_size,
+            totalElements=total,
+            items=items,
+            nextCursor=next_cursor,
+        ),
+        if_none_match,
+        etag,
+    )
 
-    total = db.query(FlightDb).count()
-    flights = db.query(FlightDb).offset(offset).limit(page_size).all()
 
-    response_items = [flight_to_response(f) for f in flights]
+@app.get("/flights/batch", response_model=List[FlightResponse])
+async def get_flights_by_numbers(
+    numbers: str = Query(..., description="Номера рейсов через запятую"),
+    db: AsyncSession = Depends(get_db),
+):
+    flight_numbers = list(dict.fromkeys(n for n in numbers.split(",") if n))
+    if len(flight_numbers) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_BATCH_SIZE} flights per request"
+        )
+
+    snapshot = catalog
+    if snapshot is not None:
+        return WireResponse(
+            [snapshot.by_number[n] for n in flight_numbers if n in snapshot.by_number]
+        )
+
+    flights = await db.execute(
+        select_flights()
+        .where(FlightDb.flight_number.in_(flight_numbers))
+        .order_by(FlightDb.id)
+    )
 
-    return PaginationResponse(
-        page=page,
-        pageSize=page_size,
-        totalElements=total,
-        items=response_items,
+    # flight_number is not unique, keep the first match like get_flight_by_number
+    found = {}
+    for flight in flights:
+        found.setdefault(flight.flight_number, flight)
+    return WireResponse(
+        [flight_to_response(found[n]) for n in flight_numbers if n in found]
     )
 
 
 @app.get("/flights/{flight_number}", response_model=FlightResponse)
-def get_flight_by_number(flight_number: str, db: Session = Depends(get_db)):
-    flight = db.query(FlightDb).filter(FlightDb.flight_number == flight_number).first()
+async def get_flight_by_number(
+    flight_number: str,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    snapshot = catalog
+    if snapshot is not None:
+        flight = snapshot.by_number.get(flight_number)
+        if not flight:
+            raise HTTPException(status_code=404, detail="Flight not found")
+        return cached_response(
+            flight, if_none_match, snapshot.etag("flight", flight_number)
+        )
+
+    flight = (
+        await db.execute(
+            select_flights()
+            .where(FlightDb.flight_number == flight_number)
+            .order_by(FlightDb.id)
+            .limit(1)
+        )
+    ).first()
 
     if not flight:
         raise HTTPException(status_code=404, detail="Flight not found")
 
-    return flight_to_response(flight)
+    return cached_response(flight_to_response(flight), if_none_match)
+
+
+@app.post("/manage/snapshot")
+async def refresh_snapshot():
+    if not FLIGHTS_SNAPSHOT:
+        raise HTTPException(status_code=409, detail="Flight snapshot is disabled")
+    fresh = await refresh_catalog()
+    return {"flights": len(fresh), "loadedAt": fresh.loaded_at}
 
 
 @app.get("/manage/health", status_code=201)
-def health():
+async def health():
     pass
+
+
+@app.get("/manage/metrics")
+async def metrics():
+    return {
+        "inflight": inflight.stats(),
+        "threadpool": threadpool_stats(),
+        "db": pool_metrics.stats(),
+    }
@@ -1,22 +1,48 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import asyncio
+import threading
+import httpx
 import pytest
+from typing import List
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import sessionmaker
+from pydantic import TypeAdapter
+from sqlalchemy import StaticPool, inspect
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 import os
 
 os.environ["TESTING"] = "True"
 
-from main import app, get_db, Base, FlightDb, AirportDb, engine
+import main
+from main import app, get_db, Base, FlightDb, AirportDb, engine, flights_count
+from common import (
+    MSGPACK_MEDIA_TYPE,
+    FlightResponse,
+    PaginationResponse,
+    encode_cursor,
+    msgpack_loads,
+)
+from migrations import current_version, migrate
+from dbtesting import assert_uses_indexes, count_queries
 
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestingSessionLocal = async_sessionmaker(
+    engine, autoflush=False, expire_on_commit=False
+)
+run = asyncio.run
 
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def drop_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 app.dependency_overrides[get_db] = override_get_db
@@ -28,21 +54,22 @@ def db_session():
     Creates a new database session for a test, using the same engine as the app.
     """
     # Create tables
-    Base.metadata.create_all(bind=engine)
+    run(create_tables())
 
     session = TestingSessionLocal()
     try:
         yield session
     finally:
-        session.close()
-        Base.metadata.drop_all(bind=engine)
+        run(session.close())
+        run(drop_tables())
 
 
 @pytest.fixture
 def client():
-    Base.metadata.create_all(bind=engine)
+    run(create_tables())
+    flights_count.invalidate()
     yield TestClient(app)
-    Base.metadata.drop_all(bind=engine)
+    run(drop_tables())
 
 
 @pytest.fixture
@@ -51,7 +78,7 @@ def sample_data(db_session):
     airport2 = AirportDb(name="Пулково", city="Санкт-Петербург", country="Россия")
     db_session.add(airport1)
     db_session.add(airport2)
-    db_session.commit()
+    run(db_session.commit())
     flight = FlightDb(
         flight_number="AFL031",
         datetime=datetime.now(),
@@ -60,7 +87,7 @@ def sample_data(db_session):
         price=1500,
     )
     db_session.add(flight)
-    db_session.commit()
+    run(db_session.commit())
     return airport1, airport2, flight
 
 
@@ -90,5 +117,310 @@ def test_get_flight(client, sample_data):
     assert data["toAirport"] == "Санкт-Петербург Пулково"
 
 
+def test_get_flights_batch(client, sample_data):
+    airport1, airport2, flight = sample_data
+
+    response = client.get(
+        "/flights/batch", params={"numbers": f"UNKNOWN,{flight.flight_number}"}
+    )
+    assert response.status_code == 200
+
+    data = response.json()
+    assert len(data) == 1
+    assert data[0]["flightNumber"] == flight.flight_number
+    assert data[0]["fromAirport"] == "Москва Шереметьево"
+    assert data[0]["toAirport"] == "Санкт-Петербург Пулково"
+
+
+def test_get_flights_batch_too_large(client):
+    numbers = ",".join(f"F{i}" for i in range(101))
+    response = client.get("/flights/batch", params={"numbers": numbers})
+    assert response.status_code == 400
+
+
+def test_flights_query_count(client, db_session, sample_data):
+    airport1, airport2, _ = sample_data
+    for i in range(20):
+        db_session.add(
+            FlightDb(
+                flight_number=f"SU{i:03}",
+                datetime=datetime(2030, 1, 1) + timedelta(hours=i),
+                from_airport_id=airport2.id if i % 2 else airport1.id,
+                to_airport_id=airport1.id if i % 2 else airport2.id,
+                price=1000 + i,
+            )
+        )
+    run(db_session.commit())
+
+    with count_queries(engine) as queries:
+        response = client.get("/flights", params={"page_size": 20})
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 20
+    # one count and one joined page query, independent of the page size
+    assert len(queries) == 2
+
+    with count_queries(engine) as queries:
+        client.get("/flights", params={"page": 2, "page_size": 5})
+    # the total comes from the cached count
+    assert len(queries) == 1
+
+    with count_queries(engine) as queries:
+        response = client.get(
+            "/flights/batch",
+            params={"numbers": ",".join(f"SU{i:03}" for i in range(20))},
+        )
+    assert len(response.json()) == 20
+    assert len(queries) == 1
+
+    with count_queries(engine) as queries:
+        response = client.get("/flights/SU001")
+    assert response.json()["fromAirport"] == "Санкт-Петербург Пулково"
+    assert len(queries) == 1
+
+
+def test_get_flights_cursor(client, db_session, sample_data):
+    airport1, airport2, _ = sample_data
+    # equal datetimes exercise the id tie-breaker
+    for i in range(7):
+        db_session.add(
+            FlightDb(
+                flight_number=f"SU{i:03}",
+                datetime=datetime(2030, 1, 1) + timedelta(hours=i // 2),
+                from_airport_id=airport1.id,
+                to_airport_id=airport2.id,
+                price=1000 + i,
+            )
+        )
+    run(db_session.commit())
+
+    seen = []
+    cursor = ""
+    while cursor is not None:
+        response = client.get("/flights", params={"page_size": 3, "cursor": cursor})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["totalElements"] == 8
+        seen += [item["flightNumber"] for item in data["items"]]
+        cursor = data["nextCursor"]
+    assert seen == ["AFL031"] + [f"SU{i:03}" for i in range(7)]
+
+    response = client.get("/flights")
+    assert response.json()["nextCursor"] is None
+    response = client.get("/flights", params={"cursor": "garbage"})
+    assert response.status_code == 400
+
+
+def test_flights_snapshot(client, db_session, sample_data, monkeypatch):
+    airport1, airport2, _ = sample_data
+    for i in range(5):
+        db_session.add(
+            FlightDb(
+                flight_number=f"SU{i:03}",
+                datetime=datetime(2030, 1, 1) - timedelta(days=i),
+                from_airport_id=airport1.id,
+                to_airport_id=airport2.id,
+                price=1000 + i,
+            )
+        )
+    run(db_session.commit())
+
+    requests = [
+        ("/flights", {"page": 2, "page_size": 2}),
+        ("/flights", {"page_size": 4, "cursor": ""}),
+        ("/flights/batch", {"numbers": "SU004,UNKNOWN,AFL031"}),
+        ("/flights/SU003", {}),
+        ("/flights/UNKNOWN", {}),
+    ]
+    from_db = [client.get(url, params=params) for url, params in requests]
+
+    monkeypatch.setattr(main, "FLIGHTS_SNAPSHOT", True)
+    monkeypatch.setattr(main, "catalog", None)
+    response = client.post("/manage/snapshot")
+    assert response.status_code == 200
+    assert response.json()["flights"] == 6
+
+    with count_queries(engine) as queries:
+        from_snapshot = [client.get(url, params=params) for url, params in requests]
+        cursor = from_snapshot[1].json()["nextCursor"]
+        rest = client.get("/flights", params={"page_size": 4, "cursor": cursor})
+    assert queries == []
+    for db_response, snapshot_response in zip(from_db, from_snapshot):
+        assert db_response.status_code == snapshot_response.status_code
+        assert db_response.json() == snapshot_response.json()
+    assert [f["flightNumber"] for f in rest.json()["items"]] == ["SU001", "SU000"]
+    assert rest.json()["nextCursor"] is None
+
+
+def test_snapshot_refresh_does_not_block_readers(client, sample_data, monkeypatch):
+    monkeypatch.setattr(main, "FLIGHTS_SNAPSHOT", True)
+    monkeypatch.setattr(main, "catalog", None)
+    assert client.post("/manage/snapshot").status_code == 200
+
+    building, served = threading.Event(), threading.Event()
+    served_during_build = []
+    build = main.FlightCatalog
+
+    def slow_build(rows):
+        # stands in for a catalog large enough to take a while
+        building.set()
+        served_during_build.append(served.wait(5))
+        return build(rows)
+
+    monkeypatch.setattr(main, "FlightCatalog", slow_build)
+
+    async def read_while_refreshing():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as http:
+            refresh = asyncio.ensure_future(main.refresh_catalog())
+            await asyncio.to_thread(building.wait, 5)
+            response = await http.get("/flights")
+            served.set()
+            await refresh
+        return response
+
+    response = run(read_while_refreshing())
+    assert response.status_code == 200
+    assert response.json()["totalElements"] == 1
+    assert served_during_build == [True]
+
+
+def test_flights_snapshot_takes_no_connection(client, sample_data, monkeypatch):
+    monkeypatch.delitem(app.dependency_overrides, get_db)
+    monkeypatch.setattr(main, "FLIGHTS_SNAPSHOT", True)
+    monkeypatch.setattr(main, "catalog", None)
+    assert client.post("/manage/snapshot").status_code == 200
+    checkouts = client.get("/manage/metrics").json()["db"]["checkouts"]
+
+    for _ in range(10):
+        assert client.get("/flights").status_code == 200
+        assert client.get("/flights/AFL031").status_code == 200
+
+    db = client.get("/manage/metrics").json()["db"]
+    assert db["checkouts"] == checkouts
+    assert db["checkedOut"] == 0
+
+
+def test_flight_queries_use_indexes(client, sample_data):
+    _, _, flight = sample_data
+    flight_number = flight.flight_number
+    cursor = encode_cursor(datetime(2000, 1, 1).isoformat(), 0)
+
+    for url, params in [
+        (f"/flights/{flight_number}", {}),
+        ("/flights/batch", {"numbers": flight_number}),
+        ("/flights", {"cursor": ""}),
+        ("/flights", {"cursor": cursor}),
+    ]:
+        with count_queries(engine) as queries:
+            assert client.get(url, params=params).status_code == 200
+        assert_uses_indexes(engine, queries)
+
+
+def test_migrations_are_versioned():
+    fresh = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+
+    def drop_indexes(conn):
+        Base.metadata.create_all(conn)
+        for index in FlightDb.__table__.indexes:
+            index.drop(conn)
+
+    def get_indexes(conn):
+        return {index["name"] for index in inspect(conn).get_indexes("flight")}
+
+    async def upgrade():
+        async with fresh.begin() as conn:
+            await conn.run_sync(drop_indexes)
+        applied = [
+            await migrate(fresh, main.MIGRATIONS),
+            await migrate(fresh, main.MIGRATIONS),
+        ]
+        version = await current_version(fresh)
+        async with fresh.connect() as conn:
+            indexes = await conn.run_sync(get_indexes)
+        await fresh.dispose()
+        return applied, version, indexes
+
+    applied, version, indexes = run(upgrade())
+    assert applied == [[1], []]
+    assert version == 1
+    assert indexes == {"ix_flight_flight_number", "ix_flight_datetime_id"}
+
+
+def test_conditional_get(client, db_session, sample_data, monkeypatch):
+    airport1, airport2, flight = sample_data
+
+    etags = {}
+    for url in ["/flights", f"/flights/{flight.flight_number}"]:
+        response = client.get(url)
+        etag = etags[url] = response.headers["ETag"]
+        assert response.headers["Cache-Control"] == "no-cache"
+
+        response = client.get(url, headers={"If-None-Match": f'"other", W/{etag}'})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["ETag"] == etag
+        assert response.headers["Vary"] == "Accept"
+
+    db_session.add(
+        FlightDb(
+            flight_number="SU100",
+            datetime=datetime(2030, 1, 1),
+            from_airport_id=airport1.id,
+            to_airport_id=airport2.id,
+            price=900,
+        )
+    )
+    run(db_session.commit())
+    flights_count.invalidate()
+    response = client.get("/flights", headers={"If-None-Match": etags["/flights"]})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etags["/flights"]
+
+    monkeypatch.setattr(main, "FLIGHTS_SNAPSHOT", True)
+    monkeypatch.setattr(main, "catalog", None)
+    client.post("/manage/snapshot")
+    for url in ["/flights", "/flights/SU100"]:
+        etag = client.get(url).headers["ETag"]
+        with count_queries(engine) as queries:
+            response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["Vary"] == "Accept"
+        assert queries == []
+
+    # a refresh with the same flights keeps the ETags valid
+    client.post("/manage/snapshot")
+    response = client.get("/flights/SU100", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_msgpack_negotiation(client, sample_data):
+    _, _, flight = sample_data
+    msgpack_accept = {"Accept": f"{MSGPACK_MEDIA_TYPE}, application/json;q=0.5"}
+
+    for url, params, model in [
+        ("/flights", {}, PaginationResponse),
+        (f"/flights/{flight.flight_number}", {}, FlightResponse),
+        ("/flights/batch", {"numbers": flight.flight_number}, List[FlightResponse]),
+    ]:
+        as_json = client.get(url, params=params)
+        as_msgpack = client.get(url, params=params, headers=msgpack_accept)
+        assert as_json.headers["Content-Type"] == "application/json"
+        assert as_msgpack.headers["Content-Type"] == MSGPACK_MEDIA_TYPE
+        assert as_msgpack.headers["Vary"] == "Accept"
+        assert len(as_msgpack.content) < len(as_json.content)
+        adapter = TypeAdapter(model)
+        assert adapter.validate_python(
+            msgpack_loads(as_msgpack.content)
+        ) == adapter.validate_json(as_json.content)
+        if "ETag" in as_json.headers:
+            assert as_msgpack.headers["ETag"] != as_json.headers["ETag"]
+
+    # JSON stays the default and wins when preferred
+    response = client.get(
+        "/flights", headers={"Accept": f"application/json, {MSGPACK_MEDIA_TYPE};q=0.5"}
+    )
+    assert response.headers["Content-Type"] == "application/json"
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
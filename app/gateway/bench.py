@@ -0,0 +1,135 @@
+"""
+Microbenchmarks of the gateway hot paths. See app/benchmark.py.
+"""
+
+from uuid import uuid4
+import json
+import os
+
+os.environ.setdefault("FLIGHTS_SERVICE_URL", "http://flights")
+os.environ.setdefault("TICKETS_SERVICE_URL", "http://tickets")
+os.environ.setdefault("PRIVILEGES_SERVICE_URL", "http://bonus")
+
+from pydantic import TypeAdapter
+
+from main import map_ticket_to_ticket_response
+from services import list_adapter
+from common import *
+from benchmark import main
+
+# JSON payloads as the downstream services return them
+TICKETS_JSON = [
+    {
+        "id": i,
+        "ticket_uid": str(uuid4()),
+        "username": "moose",
+        "flight_number": f"AFL{i % 100:03d}",
+        "price": 1500,
+        "status": "PAID",
+    }
+    for i in range(1, 1001)
+]
+HISTORY_JSON = [
+    {
+        "id": i,
+        "privilege_id": 1,
+        "ticket_uid": str(uuid4()),
+        "datetime": "2021-10-08T20:00:00",
+        "balance_diff": 150,
+        "operation_type": "FILL_IN_BALANCE",
+    }
+    for i in range(1, 1001)
+]
+FLIGHTS = {
+    f"AFL{i:03d}": FlightResponse(
+        flightNumber=f"AFL{i:03d}",
+        fromAirport="Санкт-Петербург Пулково",
+        toAirport="Москва Шереметьево",
+        date="2021-10-08T20:00:00+00:00",
+        price=1500,
+    )
+    for i in range(100)
+}
+TICKETS = [Ticket.model_validate(t) for t in TICKETS_JSON]
+
+# Downstream bodies of one /me request for a user with 100 tickets
+ME_TICKETS_BODY = json.dumps(TICKETS_JSON[:100]).encode()
+ME_PRIVILEGE_BODY = json.dumps(
+    {"id": 1, "username": "moose", "status": "BRONZE", "balance": 1500}
+).encode()
+ME_FLIGHTS_BODY = json.dumps(
+    [f.model_dump(mode="json") for f in FLIGHTS.values()]
+).encode()
+USER_INFO = TypeAdapter(UserInfoResponse)
+
+
+def me_validated() -> bytes:
+    """
+    /me validating at every hop: downstream JSON into models, the models
+    into response models, and the result again by FastAPI's response_model.
+    """
+    tickets = [Ticket.model_validate(x) for x in json.loads(ME_TICKETS_BODY)]
+    privilege = Privilege.model_validate(json.loads(ME_PRIVILEGE_BODY))
+    flights = {
+        f.flightNumber: f
+        for f in (FlightResponse.model_validate(x) for x in json.loads(ME_FLIGHTS_BODY))
+    }
+    body = UserInfoResponse(
+        tickets=[
+            TicketResponse(
+                ticketUid=t.ticket_uid,
+                flightNumber=t.flight_number,
+                fromAirport=flights[t.flight_number].fromAirport,
+                toAirport=flights[t.flight_number].toAirport,
+                date=flights[t.flight_number].date,
+                price=flights[t.flight_number].price,
+                status=t.status,
+            )
+            for t in tickets
+        ],
+        privilege=PrivilegeShortInfo(
+            balance=privilege.balance, status=privilege.status
+        ),
+    )
+    return USER_INFO.dump_json(USER_INFO.validate_python(body))
+
+
+def me_fast() -> bytes:
+    """
+    /me the way the gateway builds it now: downstream bodies validated in one
+    pass from bytes and the result sent in a FastJSONResponse.
+    """
+    tickets = list_adapter(Ticket).validate_json(ME_TICKETS_BODY)
+    privilege = Privilege.model_validate_json(ME_PRIVILEGE_BODY)
+    flights = {
+        f.flightNumber: f
+        for f in list_adapter(FlightResponse).validate_json(ME_FLIGHTS_BODY)
+    }
+    body = UserInfoResponse(
+        tickets=[
+            map_ticket_to_ticket_response(t, flights[t.flight_number]) for t in tickets
+        ],
+        privilege=PrivilegeShortInfo(
+            balance=privilege.balance, status=privilege.status
+        ),
+    )
+    return FastJSONResponse(body).body
+
+
+BENCHMARKS = {
+    "Ticket.model_validate x1000 JSON": lambda: [
+        Ticket.model_validate(t) for t in TICKETS_JSON
+    ],
+    "PrivilegeHistory.model_validate x1000 JSON": lambda: [
+        PrivilegeHistory.model_validate(h) for h in HISTORY_JSON
+    ],
+    "map_ticket_to_ticket_response x1000": lambda: [
+        map_ticket_to_ticket_response(t, FLIGHTS[t.flight_number]) for t in TICKETS
+    ],
+    "/me x100 tickets validated": me_validated,
+    "/me x100 tickets fast path": me_fast,
+}
+
+
+if __name__ == "__main__":
+    main(BENCHMARKS)
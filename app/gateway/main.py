@@ -1,6 +1,12 @@
-from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Query, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+import asyncio
+import httpx
+import logging
+import math
 import os
 import datetime
 import uuid
@@ -13,6 +19,9 @@ sys.path.insert(0, parentdir)
 
 from common import *
 from services import *
+from metrics import InFlight, InFlightMiddleware, threadpool_stats
+
+logger = logging.getLogger(__name__)
 
 FLIGHTS_SERVICE_URL = os.getenv("FLIGHTS_SERVICE_URL")
 TICKETS_SERVICE_URL = os.getenv("TICKETS_SERVICE_URL")
@@ -28,10 +37,25 @@ if PRIVILEGES_SERVICE_URL is None:
 flights_service = FlightsService(FLIGHTS_SERVICE_URL)
 tickets_service = TicketsService(TICKETS_SERVICE_URL)
 privileges_service = PrivilegesService(PRIVILEGES_SERVICE_URL)
+services = (flights_service, tickets_service, privileges_service)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for service in services:
+        await service.start()
+    try:
+        yield
+    finally:
+        for service in services:
+            await service.close()
 
 
 # FastAPI app
-app = FastAPI(title="App API", root_path="/api/v1")
+app = FastAPI(title="App API", root_path="/api/v1", lifespan=lifespan)
+inflight = InFlight()
+app.add_middleware(InFlightMiddleware, inflight=inflight)
+instrument(app)
 
 
 class TicketBuyBody(BaseModel):
@@ -41,18 +65,39 @@ class TicketBuyBody(BaseModel):
 
 
 def error_response(msg, code):
-    return JSONResponse(
+    return FastJSONResponse(
         content=ErrorResponse(message=msg).model_dump(), status_code=code
     )
 
 
-@app.get("/flights", response_model=PaginationResponse)
-def get_flights(page: int = None, size: int = None):
-    return flights_service.get_all(page, size)
+@app.exception_handler(ServiceUnavailable)
+async def service_unavailable(request, exc: ServiceUnavailable):
+    if exc.reason == "timeout":
+        return error_response(f"Сервис {exc.service} не ответил вовремя", 504)
+    response = error_response(f"Сервис {exc.service} недоступен", 503)
+    if exc.retry_after is not None:
+        response.headers["Retry-After"] = str(math.ceil(exc.retry_after))
+    return response
+
 
+# The read endpoints below build their response models from downstream data
+# validated once in services.py and return them in a FastJSONResponse, so
+# FastAPI's response_model does not validate and serialize them a second time.
 
-def map_ticket_to_ticket_response(tick):
-    flight = flights_service.get_flight_by_number(tick.flight_number)
+
+@app.get("/flights", response_model=PaginationResponse)
+async def get_flights(
+    page: Optional[int] = Query(None, ge=1),
+    size: Optional[int] = Query(None, ge=1, le=100),
+    cursor: Optional[str] = None,
+):
+    try:
+        return FastJSONResponse(await flights_service.get_all(page, size, cursor))
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+
+def map_ticket_to_ticket_response(tick, flight):
     return TicketResponse(
         ticketUid=tick.ticket_uid,
         flightNumber=tick.flight_number,
@@ -64,45 +109,108 @@ def map_ticket_to_ticket_response(tick):
     )
 
 
+async def map_tickets_to_ticket_responses(tickets_info, fanout: FanOut):
+    flights = await fanout.call(
+        "flights",
+        flights_service.get_flights_by_numbers(
+            tick.flight_number for tick in tickets_info
+        ),
+    )
+    return [
+        map_ticket_to_ticket_response(tick, flights[tick.flight_number])
+        for tick in tickets_info
+    ]
+
+
+async def all_user_tickets(username, status):
+    return await tickets_service.get_user_tickets(username, status), None
+
+
 @app.get("/tickets")
-def get_tickets(x_user_name: str = Header()) -> List[TicketResponse]:
-    privilege = privileges_service.get_user_privelge(x_user_name)
+async def get_tickets(
+    x_user_name: str = Header(),
+    size: Optional[int] = Query(None, ge=1, le=100),
+    cursor: Optional[str] = None,
+    status: Optional[TicketStatus] = None,
+) -> List[TicketResponse]:
+    """
+    All tickets of the user, or with `size` or `cursor` one page of them with
+    the cursor of the next page in X-Next-Cursor. Only the returned tickets
+    are enriched with their flights.
+    """
+    status = status.value if status else None
+    if size is None and cursor is None:
+        tickets_page = all_user_tickets(x_user_name, status)
+    else:
+        tickets_page = tickets_service.get_user_tickets_page(
+            x_user_name, status, size or TICKETS_PAGE_SIZE, cursor
+        )
+    fanout = FanOut()
+    try:
+        privilege, (tickets_info, next_cursor) = await fanout.gather(
+            privilege=privileges_service.get_user_privelge(x_user_name),
+            tickets=tickets_page,
+        )
+    except ValueError as e:
+        return error_response(str(e), 400)
     if privilege is None:
         return error_response("Пользователь не найден", 404)
-    tickets_info = tickets_service.get_user_tickets(x_user_name)
-    tickets = []
-    for tick in tickets_info:
-        tickets.append(map_ticket_to_ticket_response(tick))
-    return tickets
+    tickets = await map_tickets_to_ticket_responses(tickets_info, fanout)
+    headers = {"Server-Timing": fanout.server_timing()}
+    if next_cursor:
+        headers[NEXT_CURSOR_HEADER] = next_cursor
+    return FastJSONResponse(tickets, headers=headers)
+
+
+@app.get("/tickets/export")
+async def export_tickets(
+    x_user_name: str = Header(), status: Optional[TicketStatus] = None
+):
+    """
+    All tickets of the user as NDJSON, relayed from the tickets service
+    chunk by chunk without enriching them with flights.
+    """
+    upstream = await tickets_service.export_user_tickets(
+        x_user_name, status.value if status else None
+    )
+    return StreamingResponse(
+        upstream.aiter_raw(),
+        media_type=NDJSON_MEDIA_TYPE,
+        background=BackgroundTask(upstream.aclose),
+    )
 
 
 @app.get("/me")
-def get_user(x_user_name: str = Header()) -> UserInfoResponse | ErrorResponse:
-    privilege = privileges_service.get_user_privelge(x_user_name)
+async def get_user(x_user_name: str = Header()) -> UserInfoResponse | ErrorResponse:
+    fanout = FanOut()
+    privilege, tickets_info = await fanout.gather(
+        privilege=privileges_service.get_user_privelge(x_user_name),
+        tickets=tickets_service.get_user_tickets(x_user_name),
+    )
     if privilege is None:
         return error_response("Пользователь не найден", 404)
-    tickets_info = tickets_service.get_user_tickets(x_user_name)
-    tickets = []
-    for tick in tickets_info:
-        tickets.append(map_ticket_to_ticket_response(tick))
-    return UserInfoResponse(
-        tickets=tickets,
-        privilege=PrivilegeShortInfo(
-            balance=privilege.balance, status=privilege.status
+    tickets = await map_tickets_to_ticket_responses(tickets_info, fanout)
+    return FastJSONResponse(
+        UserInfoResponse(
+            tickets=tickets,
+            privilege=PrivilegeShortInfo(
+                balance=privilege.balance, status=privilege.status
+            ),
         ),
+        headers={"Server-Timing": fanout.server_timing()},
     )
 
 
 @app.get("/tickets/{ticket_uid}")
-def get_ticket(
+async def get_ticket(
     ticket_uid: uuid.UUID, x_user_name: str = Header()
 ) -> TicketResponse | ErrorResponse:
-    ticket = tickets_service.get_ticket(ticket_uid)
+    ticket = await tickets_service.get_ticket(ticket_uid)
     if ticket is None:
         return error_response("Билет не найден", 404)
     if ticket.username != x_user_name:
         return error_response("Билет не пренадлежит пользователю", 403)
-    flight = flights_service.get_flight_by_number(ticket.flight_number)
+    flight = await flights_service.get_flight_by_number(ticket.flight_number)
     if flight is None:
         return error_response("Перелет не найден", 404)
 
@@ -115,57 +223,119 @@ def get_ticket(
         price=ticket.price,
         status=ticket.status,
     )
-    return resp
+    return FastJSONResponse(resp)
+
+
+def plan_payment(priv, balance, price, paid_from_balance, ticket_uid, now):
+    """
+    Splits a ticket price into money and bonuses given the current balance.
+    Returns the two amounts and the bonus transaction to record, if any.
+    """
+    if paid_from_balance:
+        paid_by_bonus = min(balance, price)
+        if not paid_by_bonus:
+            return price, 0, None
+        return (
+            price - paid_by_bonus,
+            paid_by_bonus,
+            AddTranscationRequest(
+                privilege_id=priv.id,
+                ticket_uid=ticket_uid,
+                datetime=now,
+                balance_diff=paid_by_bonus,
+                operation_type="DEBIT_THE_ACCOUNT",
+            ),
+        )
+    return (
+        price,
+        0,
+        AddTranscationRequest(
+            privilege_id=priv.id,
+            ticket_uid=ticket_uid,
+            datetime=now,
+            balance_diff=price // 10,
+            operation_type="FILL_IN_BALANCE",
+        ),
+    )
+
+
+async def write_purchase(create_tickets, add_transactions, undo_tickets, undo_bonus):
+    """
+    The tickets and the bonus transactions are independent writes. Runs them
+    together and undoes whichever succeeded if the other one failed. Returns
+    the privilege after the bonus write.
+    """
+    ticket_result, priv_result = await asyncio.gather(
+        create_tickets, add_transactions, return_exceptions=True
+    )
+    ticket_failed = isinstance(ticket_result, BaseException)
+    priv_failed = isinstance(priv_result, BaseException)
+    if ticket_failed and not priv_failed:
+        await compensate(undo_bonus())
+    if priv_failed and not ticket_failed:
+        await compensate(undo_tickets())
+    if ticket_failed:
+        raise ticket_result
+    if priv_failed:
+        raise priv_result
+    return priv_result
+
+
+def purchase_failed(exc: httpx.HTTPError):
+    """
+    Answer for a purchase whose downstream writes failed and were undone. A
+    409 from the bonus service means the balance changed meanwhile.
+    """
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 409:
+        return error_response("Баланс изменился, повторите покупку", 409)
+    return error_response("Не удалось оформить покупку", 502)
 
 
 @app.post("/tickets")
-def buy_ticket(
-    body: TicketPurchaseRequest, x_user_name: str = Header()
+async def buy_ticket(
+    response: Response, body: TicketPurchaseRequest, x_user_name: str = Header()
 ) -> TicketPurchaseResponse | ValidationErrorResponse:
-    flight = flights_service.get_flight_by_number(body.flightNumber)
+    fanout = FanOut()
+    flight, priv = await fanout.gather(
+        flight=flights_service.get_flight_by_number(body.flightNumber),
+        privilege=privileges_service.get_user_privelge(x_user_name),
+    )
     if flight is None:
         return ValidationErrorResponse(message="Ошибка валидации данных", errors=[])
-
-    priv = privileges_service.get_user_privelge(x_user_name)
     if priv is None:
         return ValidationErrorResponse(message="Пользователь не существует", errors=[])
 
     now = datetime.now()
     ticket_uid = uuid.uuid4()
+    paid_by_money, paid_by_bonus, transaction = plan_payment(
+        priv, priv.balance, flight.price, body.paidFromBalance, ticket_uid, now
+    )
 
-    paid_by_money = flight.price
-    paid_by_bonus = 0
-    if body.paidFromBalance:
-        money = min(priv.balance, flight.price)
-        paid_by_bonus = money
-        paid_by_money = flight.price - paid_by_bonus
-        if paid_by_bonus:
-            privileges_service.add_transaction(
-                x_user_name,
-                AddTranscationRequest(
-                    privilege_id=priv.id,
-                    ticket_uid=ticket_uid,
-                    datetime=now,
-                    balance_diff=paid_by_bonus,
-                    operation_type="DEBIT_THE_ACCOUNT",
+    create_ticket = fanout.call(
+        "tickets",
+        tickets_service.create_ticket(
+            ticket_uid, x_user_name, flight.flightNumber, paid_by_money
+        ),
+    )
+    try:
+        if transaction is None:
+            await create_ticket
+        else:
+            priv = await write_purchase(
+                create_ticket,
+                fanout.call(
+                    "privilege",
+                    privileges_service.add_transaction(x_user_name, transaction),
+                ),
+                lambda: tickets_service.delete_ticket(ticket_uid),
+                lambda: privileges_service.rollback_transaction(
+                    x_user_name, ticket_uid
                 ),
             )
-    else:
-        privileges_service.add_transaction(
-            x_user_name,
-            AddTranscationRequest(
-                privilege_id=priv.id,
-                ticket_uid=ticket_uid,
-                datetime=now,
-                balance_diff=paid_by_money // 10,
-                operation_type="FILL_IN_BALANCE",
-            ),
-        )
+    except httpx.HTTPError as e:
+        return purchase_failed(e)
 
-    priv = privileges_service.get_user_privelge(x_user_name)
-    tickets_service.create_ticket(
-        ticket_uid, x_user_name, flight.flightNumber, paid_by_money
-    )
+    response.headers["Server-Timing"] = fanout.server_timing()
     return TicketPurchaseResponse(
         ticketUid=ticket_uid,
         flightNumber=body.flightNumber,
@@ -180,28 +350,137 @@ def buy_ticket(
     )
 
 
+@app.post("/tickets/bulk")
+async def buy_tickets(
+    response: Response, body: BulkTicketPurchaseRequest, x_user_name: str = Header()
+) -> BulkTicketPurchaseResponse | ValidationErrorResponse:
+    """
+    Buys several tickets with one flights lookup, one bulk insert in the
+    tickets service and one bonus transaction for the whole batch.
+    """
+    fanout = FanOut()
+    flights, priv = await fanout.gather(
+        flights=flights_service.get_flights_by_numbers(
+            [t.flightNumber for t in body.tickets]
+        ),
+        privilege=privileges_service.get_user_privelge(x_user_name),
+    )
+    if any(t.flightNumber not in flights for t in body.tickets):
+        return ValidationErrorResponse(message="Ошибка валидации данных", errors=[])
+    if priv is None:
+        return ValidationErrorResponse(message="Пользователь не существует", errors=[])
+
+    now = datetime.now()
+    balance = priv.balance
+    purchases = []
+    transactions = []
+    for ticket in body.tickets:
+        flight = flights[ticket.flightNumber]
+        ticket_uid = uuid.uuid4()
+        paid_by_money, paid_by_bonus, transaction = plan_payment(
+            priv, balance, flight.price, ticket.paidFromBalance, ticket_uid, now
+        )
+        if transaction is not None:
+            transactions.append(transaction)
+            balance += transaction.balance_diff * (
+                1 if transaction.operation_type == "FILL_IN_BALANCE" else -1
+            )
+        purchases.append((ticket_uid, flight, paid_by_money, paid_by_bonus))
+
+    ticket_uids = [p[0] for p in purchases]
+    create_tickets = fanout.call(
+        "tickets",
+        tickets_service.create_tickets(
+            [
+                TicketCreateRequest(
+                    ticketUid=ticket_uid,
+                    username=x_user_name,
+                    flightNumber=flight.flightNumber,
+                    price=paid_by_money,
+                )
+                for ticket_uid, flight, paid_by_money, _ in purchases
+            ]
+        ),
+    )
+    try:
+        if not transactions:
+            await create_tickets
+        else:
+            priv = await write_purchase(
+                create_tickets,
+                fanout.call(
+                    "privilege",
+                    privileges_service.add_transactions(x_user_name, transactions),
+                ),
+                lambda: tickets_service.delete_tickets(ticket_uids),
+                lambda: privileges_service.rollback_transactions(
+                    x_user_name, [t.ticket_uid for t in transactions]
+                ),
+            )
+    except httpx.HTTPError as e:
+        return purchase_failed(e)
+
+    response.headers["Server-Timing"] = fanout.server_timing()
+    privilege = PrivilegeShortInfo(balance=priv.balance, status=priv.status)
+    return BulkTicketPurchaseResponse(
+        tickets=[
+            TicketPurchaseResponse(
+                ticketUid=ticket_uid,
+                flightNumber=flight.flightNumber,
+                fromAirport=flight.fromAirport,
+                toAirport=flight.toAirport,
+                date=now,
+                price=flight.price,
+                paidByMoney=paid_by_money,
+                paidByBonuses=paid_by_bonus,
+                status="PAID",
+                privilege=privilege,
+            )
+            for ticket_uid, flight, paid_by_money, paid_by_bonus in purchases
+        ],
+        privilege=privilege,
+    )
+
+
+async def compensate(undo):
+    try:
+        await undo
+    except Exception:
+        logger.exception("Compensation of a failed ticket purchase failed")
+
+
 @app.delete("/tickets/{ticket_uid}", status_code=204)
-def return_ticket(ticket_uid: uuid.UUID, x_user_name: str = Header()):
-    ticket = tickets_service.get_ticket(ticket_uid)
+async def return_ticket(ticket_uid: uuid.UUID, x_user_name: str = Header()):
+    ticket = await tickets_service.get_ticket(ticket_uid)
     if ticket is None:
         return error_response("Билет не существует", 404)
     if ticket.username != x_user_name:
         return error_response("Билет не принадлежит пользователю", 403)
     if ticket.status != "PAID":
         return error_response("Билет не может быть отменен", 400)
-    if privileges_service.get_user_privelge_transaction(x_user_name, ticket_uid):
-        privileges_service.rollback_transaction(x_user_name, ticket_uid)
-    tickets_service.delete_ticket(ticket_uid)
+    if await privileges_service.get_user_privelge_transaction(x_user_name, ticket_uid):
+        await privileges_service.rollback_transaction(x_user_name, ticket_uid)
+    await tickets_service.delete_ticket(ticket_uid)
 
 
 @app.get("/privilege")
-def get_privilege(x_user_name: str = Header()) -> PrivilegeInfoResponse:
-    a = privileges_service.get_user_privelge(x_user_name)
+async def get_privilege(
+    x_user_name: str = Header(),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+) -> PrivilegeInfoResponse:
+    fanout = FanOut()
+    try:
+        a = await fanout.call(
+            "privilege",
+            privileges_service.get_user_privelge_summary(x_user_name, limit, cursor),
+        )
+    except ValueError as e:
+        return error_response(str(e), 400)
     if a is None:
         return error_response("Пользователь не сущесвует", 404)
-    b = privileges_service.get_user_privelge_history(x_user_name)
     his = []
-    for it in b:
+    for it in a.history:
         his.append(
             BalanceHistory(
                 date=it.datetime,
@@ -210,9 +489,58 @@ def get_privilege(x_user_name: str = Header()) -> PrivilegeInfoResponse:
                 operationType=it.operation_type,
             )
         )
-    return PrivilegeInfoResponse(balance=a.balance, status=a.status, history=his)
+    return FastJSONResponse(
+        PrivilegeInfoResponse(
+            balance=a.balance, status=a.status, history=his, nextCursor=a.nextCursor
+        ),
+        headers={"Server-Timing": fanout.server_timing()},
+    )
+
+
+@app.get("/privilege/export")
+async def export_privilege_history(x_user_name: str = Header()):
+    """
+    The user's whole balance history as NDJSON, relayed from the bonus
+    service chunk by chunk.
+    """
+    upstream = await privileges_service.export_history(x_user_name)
+    if upstream is None:
+        return error_response("Пользователь не сущесвует", 404)
+    return StreamingResponse(
+        upstream.aiter_raw(),
+        media_type=NDJSON_MEDIA_TYPE,
+        background=BackgroundTask(upstream.aclose),
+    )
 
 
 @app.get("/manage/health", status_code=201)
-def health():
+async def health():
     pass
+
+
+@app.get("/manage/metrics")
+async def metrics():
+    downstream = {
+        "flights": flights_service,
+        "tickets": tickets_service,
+        "privileges": privileges_service,
+    }
+    return {
+        "inflight": inflight.stats(),
+        "threadpool": threadpool_stats(),
+        "downstream": {
+            name: {
+                "pool": service.pool_stats(),
+                "singleflight": service.singleflight.stats(),
+                "breaker": service.breaker.stats(),
+                "hedging": service.hedger.stats(),
+                "timeoutBudget": service.budget,
+            }
+            for name, service in downstream.items()
+        },
+        "flightCache": flights_service.cache.stats(),
+        "flightRepresentations": {
+            **flights_service.representations.stats(),
+            "notModified": flights_service.not_modified,
+        },
+    }
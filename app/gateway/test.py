@@ -0,0 +1,899 @@
+from datetime import datetime
+from uuid import UUID, uuid4
+import asyncio
+import json
+import time
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+import os
+
+os.environ.setdefault("FLIGHTS_SERVICE_URL", "http://flights")
+os.environ.setdefault("TICKETS_SERVICE_URL", "http://tickets")
+os.environ.setdefault("PRIVILEGES_SERVICE_URL", "http://bonus")
+
+from main import app, flights_service, tickets_service, privileges_service
+import services
+from services import (
+    CircuitBreaker,
+    FanOut,
+    Hedger,
+    TTLCache,
+    MISSING,
+    FlightsService,
+)
+from common import (
+    PaginationResponse,
+    PrivilegeInfoResponse,
+    Registry,
+    TicketResponse,
+    UserInfoResponse,
+    decode_cursor,
+    encode_cursor,
+    make_etag,
+    msgpack_dumps,
+    wants_msgpack,
+    MSGPACK_MEDIA_TYPE,
+)
+from benchmark import compare, run
+
+FLIGHT = {
+    "flightNumber": "AFL031",
+    "fromAirport": "Санкт-Петербург Пулково",
+    "toAirport": "Москва Шереметьево",
+    "date": "2021-10-08T20:00:00+00:00",
+    "price": 1500,
+}
+
+
+class Backends:
+    """
+    In-memory stand-ins for the flights, tickets and bonus services.
+    """
+
+    def __init__(self):
+        self.tickets = {}
+        self.privilege = {
+            "id": 1,
+            "username": "moose",
+            "status": "BRONZE",
+            "balance": 0,
+        }
+        self.history = []
+        self.calls = []
+        self.request_ids = set()
+        self.tickets_params = []
+        self.fail = set()
+        self.fail_status = 500
+        self.refuse = set()
+        self.streams_closed = 0
+        self.if_none_match = []
+        self.delay = {}
+
+    def transport(self, service, handler):
+        """
+        Serves the handler after the delay currently set for the service,
+        or after the next one of a list of delays.
+        """
+
+        async def handle(request: httpx.Request):
+            if service in self.refuse:
+                raise httpx.ConnectError("Connection refused", request=request)
+            delay = self.delay.get(service, 0)
+            if isinstance(delay, list):
+                delay = delay.pop(0) if delay else 0
+            await asyncio.sleep(delay)
+            return handler(request)
+
+        return httpx.MockTransport(handle)
+
+    def flights(self, request: httpx.Request):
+        self.calls.append(("flights", request.method, request.url.path))
+        self.request_ids.add(request.headers.get("X-Request-ID"))
+        if request.url.path == "/flights":
+            self.flights_params = dict(request.url.params)
+            return self.cacheable(
+                request,
+                {"page": 1, "pageSize": 10, "totalElements": 1, "items": [FLIGHT]},
+            )
+        if request.url.path == "/flights/batch":
+            numbers = request.url.params["numbers"].split(",")
+            return httpx.Response(
+                200, json=[FLIGHT] if FLIGHT["flightNumber"] in numbers else []
+            )
+        if request.url.path == f"/flights/{FLIGHT['flightNumber']}":
+            return self.cacheable(request, FLIGHT)
+        return httpx.Response(404, json={"detail": "Flight not found"})
+
+    def cacheable(self, request: httpx.Request, body):
+        etag = make_etag(json.dumps(body).encode())
+        self.if_none_match.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(200, json=body, headers={"ETag": etag})
+
+    def tickets_(self, request: httpx.Request):
+        self.calls.append(("tickets", request.method, request.url.path))
+        self.request_ids.add(request.headers.get("X-Request-ID"))
+        if ("tickets", request.method) in self.fail:
+            return httpx.Response(self.fail_status)
+        parts = request.url.path.strip("/").split("/")
+        if parts[:2] == ["tickets", "user"] and parts[3:] == ["export"]:
+            tickets = [t for t in self.tickets.values() if t["username"] == parts[2]]
+            return self.ndjson(tickets)
+        if parts[:2] == ["tickets", "user"]:
+            params = request.url.params
+            self.tickets_params.append(dict(params))
+            tickets = [
+                t
+                for t in self.tickets.values()
+                if t["username"] == parts[2]
+                and t["status"] == params.get("status", t["status"])
+            ]
+            if "cursor" in params:
+                (after,) = decode_cursor(params["cursor"])
+                tickets = [t for t in tickets if t["id"] > after]
+            headers = {"Server-Timing": "db;dur=2.5"}
+            limit = int(params.get("limit", len(tickets)))
+            if len(tickets) > limit:
+                tickets = tickets[:limit]
+                headers["X-Next-Cursor"] = encode_cursor(tickets[-1]["id"])
+            return httpx.Response(200, json=tickets, headers=headers)
+        if request.method == "POST":
+            body = httpx.Response(200, content=request.content).json()
+            for ticket in body.get("tickets", [body]):
+                self.tickets[ticket["ticketUid"]] = {
+                    "id": len(self.tickets) + 1,
+                    "ticket_uid": ticket["ticketUid"],
+                    "username": ticket["username"],
+                    "flight_number": ticket["flightNumber"],
+                    "price": ticket["price"],
+                    "status": "PAID",
+                }
+            return httpx.Response(201)
+        if parts == ["tickets"] and request.method == "DELETE":
+            for ticket_uid in request.url.params.get_list("ticket_uid"):
+                self.tickets.pop(ticket_uid, None)
+            return httpx.Response(204)
+        ticket = self.tickets.get(parts[1])
+        if ticket is None:
+            return httpx.Response(404, json={"detail": "Ticket not found"})
+        if request.method == "DELETE":
+            del self.tickets[parts[1]]
+            return httpx.Response(204)
+        return httpx.Response(200, json=ticket)
+
+    def bonus(self, request: httpx.Request):
+        self.calls.append(("bonus", request.method, request.url.path))
+        self.request_ids.add(request.headers.get("X-Request-ID"))
+        if ("bonus", request.method) in self.fail:
+            return httpx.Response(self.fail_status)
+        parts = request.url.path.strip("/").split("/")
+        if parts[1] != self.privilege["username"]:
+            return httpx.Response(404, json={"detail": "Privilege not found"})
+        if len(parts) == 2:
+            self.accept = request.headers.get("Accept")
+            if wants_msgpack(self.accept):
+                return httpx.Response(
+                    200,
+                    content=msgpack_dumps(self.privilege),
+                    headers={"Content-Type": MSGPACK_MEDIA_TYPE},
+                )
+            return httpx.Response(200, json=self.privilege)
+        if parts[2] == "summary":
+            limit = int(request.url.params.get("limit", len(self.history)))
+            history = sorted(self.history, key=lambda h: h["datetime"], reverse=True)
+            return httpx.Response(
+                200,
+                json={**self.privilege, "history": history[:limit], "nextCursor": None},
+            )
+        if request.method == "POST":
+            body = httpx.Response(200, content=request.content).json()
+            for entry in body.get("transactions", [body]):
+                if entry["operation_type"] == "FILL_IN_BALANCE":
+                    self.privilege["balance"] += entry["balance_diff"]
+                else:
+                    self.privilege["balance"] -= entry["balance_diff"]
+                self.history.append({"id": len(self.history) + 1, **entry})
+            return httpx.Response(201, json=self.privilege)
+        if parts[2:] == ["history", "export"]:
+            return self.ndjson(self.history)
+        if len(parts) == 3 and request.method == "DELETE":
+            for ticket_uid in request.url.params.get_list("ticket_uid"):
+                self.rollback(ticket_uid)
+            return httpx.Response(204)
+        if len(parts) == 3:
+            return httpx.Response(200, json=self.history)
+        entry = next((h for h in self.history if h["ticket_uid"] == parts[3]), None)
+        if entry is None:
+            return httpx.Response(404, json={"detail": "History entry not found"})
+        if request.method == "DELETE":
+            self.rollback(parts[3])
+            return httpx.Response(204)
+        return httpx.Response(200, json=entry)
+
+    def ndjson(self, rows):
+        async def stream():
+            try:
+                for row in rows:
+                    yield (json.dumps(row) + "\n").encode()
+            finally:
+                self.streams_closed += 1
+
+        return httpx.Response(
+            200, content=stream(), headers={"Content-Type": "application/x-ndjson"}
+        )
+
+    def rollback(self, ticket_uid):
+        entry = next((h for h in self.history if h["ticket_uid"] == ticket_uid), None)
+        if entry is None:
+            return
+        if entry["operation_type"] == "FILL_IN_BALANCE":
+            self.privilege["balance"] -= entry["balance_diff"]
+        else:
+            self.privilege["balance"] += entry["balance_diff"]
+        self.history.remove(entry)
+
+
+@pytest.fixture
+def backends():
+    backends = Backends()
+    flights_service.cache.clear()
+    flights_service.representations.clear()
+    flights_service.transport = backends.transport("flights", backends.flights)
+    tickets_service.transport = backends.transport("tickets", backends.tickets_)
+    privileges_service.transport = backends.transport("bonus", backends.bonus)
+    for service in (flights_service, tickets_service, privileges_service):
+        service.breaker = CircuitBreaker(
+            services.BREAKER_FAILURES, services.BREAKER_RESET_TIMEOUT
+        )
+        service.hedger = Hedger(services.HEDGE_PERCENTILE, services.HEDGE_MAX_RATIO)
+    return backends
+
+
+@pytest.fixture
+def client(backends):
+    with TestClient(app) as client:
+        yield client
+
+
+def buy(client, paid_from_balance=False, flight_number="AFL031"):
+    return client.post(
+        "/tickets",
+        headers={"X-User-Name": "moose"},
+        json={
+            "flightNumber": flight_number,
+            "price": 1500,
+            "paidFromBalance": paid_from_balance,
+        },
+    )
+
+
+def test_get_flights(client, backends):
+    response = client.get("/flights", params={"page": 1, "size": 10})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["totalElements"] == 1
+    assert data["items"][0]["flightNumber"] == FLIGHT["flightNumber"]
+    assert backends.flights_params == {"page": "1", "page_size": "10"}
+
+    calls = len(backends.calls)
+    for params in ({"size": 1000}, {"size": 0}, {"page": 0}):
+        assert client.get("/flights", params=params).status_code == 422
+    assert len(backends.calls) == calls
+
+
+def test_buy_ticket_fills_balance(client, backends):
+    response = buy(client)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["paidByMoney"] == 1500
+    assert data["paidByBonuses"] == 0
+    assert data["privilege"]["balance"] == 150
+    assert data["ticketUid"] in backends.tickets
+
+
+def test_buy_ticket_from_balance(client, backends):
+    backends.privilege["balance"] = 500
+    response = buy(client, paid_from_balance=True)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["paidByMoney"] == 1000
+    assert data["paidByBonuses"] == 500
+    assert data["privilege"]["balance"] == 0
+
+
+def test_buy_ticket_round_trips(client, backends):
+    buy(client)
+    assert [c for c in backends.calls if c[1] == "GET"] == [
+        ("flights", "GET", "/flights/AFL031"),
+        ("bonus", "GET", "/privilege/moose"),
+    ]
+
+
+def test_buy_ticket_ticket_failure_rolls_back_transaction(client, backends):
+    backends.fail.add(("tickets", "POST"))
+    assert buy(client).status_code == 502
+    assert backends.history == []
+    assert backends.privilege["balance"] == 0
+    assert ("bonus", "DELETE") in [c[:2] for c in backends.calls]
+
+
+def test_buy_ticket_transaction_failure_deletes_ticket(client, backends):
+    backends.fail.add(("bonus", "POST"))
+    assert buy(client).status_code == 502
+    assert backends.tickets == {}
+    assert ("tickets", "DELETE") in [c[:2] for c in backends.calls]
+
+    # the balance changed between the lookup and the debit
+    backends.fail_status = 409
+    backends.privilege["balance"] = 500
+    response = buy(client, paid_from_balance=True)
+    assert response.status_code == 409
+    assert response.json()["message"] == "Баланс изменился, повторите покупку"
+    assert backends.tickets == {}
+
+
+def buy_many(client, *paid_from_balance, flight_number="AFL031"):
+    return client.post(
+        "/tickets/bulk",
+        headers={"X-User-Name": "moose"},
+        json={
+            "tickets": [
+                {"flightNumber": flight_number, "price": 1500, "paidFromBalance": p}
+                for p in paid_from_balance
+            ]
+        },
+    )
+
+
+def test_buy_tickets_bulk(client, backends):
+    backends.privilege["balance"] = 2000
+    response = buy_many(client, True, True, False)
+    assert response.status_code == 200
+    data = response.json()
+    assert [(t["paidByMoney"], t["paidByBonuses"]) for t in data["tickets"]] == [
+        (0, 1500),
+        (1000, 500),
+        (1500, 0),
+    ]
+    assert data["privilege"]["balance"] == 150
+    assert len(backends.tickets) == 3
+    assert len(backends.history) == 3
+    assert [c for c in backends.calls if c[1] != "GET"] == [
+        ("tickets", "POST", "/tickets/bulk"),
+        ("bonus", "POST", "/privilege/moose/history/bulk"),
+    ]
+
+    response = buy_many(client, False, flight_number="UNKNOWN")
+    assert response.json()["message"] == "Ошибка валидации данных"
+
+
+def test_buy_tickets_bulk_compensation(client, backends):
+    backends.fail.add(("bonus", "POST"))
+    assert buy_many(client, False, False).status_code == 502
+    assert backends.tickets == {}
+    assert ("tickets", "DELETE", "/tickets") in backends.calls
+
+    backends.fail = {("tickets", "POST")}
+    assert buy_many(client, False, False).status_code == 502
+    assert backends.history == []
+    assert backends.privilege["balance"] == 0
+    assert ("bonus", "DELETE", "/privilege/moose/history") in backends.calls
+
+
+def test_get_tickets_pages(client, backends, monkeypatch):
+    for _ in range(5):
+        buy(client)
+    backends.tickets_params.clear()
+    headers = {"X-User-Name": "moose"}
+
+    seen = []
+    params = {"size": 2}
+    while True:
+        response = client.get("/tickets", params=params, headers=headers)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        seen += [t["ticketUid"] for t in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params = {"size": 2, "cursor": response.headers["X-Next-Cursor"]}
+    assert seen == list(backends.tickets)
+    assert [p["limit"] for p in backends.tickets_params] == ["2", "2", "2"]
+
+    next(iter(backends.tickets.values()))["status"] = "CANCELED"
+    response = client.get("/tickets", params={"status": "CANCELED"}, headers=headers)
+    assert [t["status"] for t in response.json()] == ["CANCELED"]
+
+    # all tickets are fetched in one unpaged call
+    monkeypatch.setattr(services, "TICKETS_PAGE_SIZE", 2)
+    backends.tickets_params.clear()
+    response = client.get("/me", headers=headers)
+    assert len(response.json()["tickets"]) == 5
+    response = client.get("/tickets", headers=headers)
+    assert len(response.json()) == 5
+    assert backends.tickets_params == [{}, {}]
+
+
+def test_get_user(client, backends):
+    buy(client)
+    buy(client)
+    response = client.get("/me", headers={"X-User-Name": "moose"})
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["tickets"]) == 2
+    assert data["tickets"][0]["fromAirport"] == FLIGHT["fromAirport"]
+    assert data["privilege"]["balance"] == 300
+
+
+def test_get_tickets_single_flights_lookup(client, backends):
+    for _ in range(3):
+        buy(client)
+    backends.calls.clear()
+    flights_service.cache.clear()
+    response = client.get("/tickets", headers={"X-User-Name": "moose"})
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+    assert [c for c in backends.calls if c[0] == "flights"] == [
+        ("flights", "GET", "/flights/batch")
+    ]
+    hops = [t.split(";")[0] for t in response.headers["Server-Timing"].split(", ")]
+    assert sorted(hops) == ["flights", "privilege", "tickets", "tickets-db"]
+
+
+def test_request_id_and_db_timing_are_propagated(client, backends):
+    buy(client)
+    backends.request_ids.clear()
+    response = client.get("/me", headers={"X-User-Name": "moose", "X-Request-ID": "r1"})
+    assert response.status_code == 200
+    assert response.headers["X-Request-ID"] == "r1"
+    assert backends.request_ids == {"r1"}
+    timings = response.headers["Server-Timing"].split(", ")
+    assert "tickets-db;dur=2.5" in timings
+
+    response = client.get("/me", headers={"X-User-Name": "moose"})
+    assert len(response.headers["X-Request-ID"]) == 32
+    assert response.headers["X-Request-ID"] in backends.request_ids
+
+
+def test_fanout_concurrency_limit():
+    running = 0
+    peak = 0
+
+    async def hop():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return running
+
+    async def main(limit):
+        fanout = FanOut(limit)
+        await fanout.gather(**{f"hop{i}": hop() for i in range(6)})
+        return fanout
+
+    assert len(asyncio.run(main(2)).timings) == 6
+    assert peak == 2
+    peak = 0
+    asyncio.run(main(6))
+    assert peak == 6
+
+
+def test_ttl_cache():
+    now = 0.0
+    cache = TTLCache(2, ttl=10, negative_ttl=1, clock=lambda: now)
+    cache.set("A", 1)
+    cache.set("B", None)
+    assert cache.get("B") is None
+    assert cache.get("A") == 1
+    cache.set("C", 3)
+    assert cache.get("B") is MISSING  # least recently used
+    now = 5.0
+    assert cache.get("A") == 1
+    now = 10.0
+    assert cache.get("A") is MISSING
+    assert cache.stats() == {
+        "size": 1,
+        "maxsize": 2,
+        "hits": 3,
+        "misses": 2,
+        "evictions": 1,
+        "expirations": 1,
+    }
+
+
+def test_flight_lookups_are_cached(client, backends):
+    ticket_uid = buy(client).json()["ticketUid"]
+    buy(client, flight_number="UNKNOWN")
+    buy(client, flight_number="UNKNOWN")
+    for _ in range(3):
+        response = client.get(
+            f"/tickets/{ticket_uid}", headers={"X-User-Name": "moose"}
+        )
+        assert response.status_code == 200
+    client.get("/me", headers={"X-User-Name": "moose"})
+    assert [c for c in backends.calls if c[0] == "flights"] == [
+        ("flights", "GET", "/flights/AFL031"),
+        ("flights", "GET", "/flights/UNKNOWN"),
+    ]
+
+
+def test_concurrent_identical_gets_are_coalesced():
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        if request.url.path == "/flights/BROKEN":
+            return httpx.Response(500)
+        return httpx.Response(200, json=FLIGHT)
+
+    async def main():
+        service = FlightsService(
+            "http://flights",
+            cache=TTLCache(0, 0, 0),
+            transport=httpx.MockTransport(handler),
+        )
+        await service.start()
+        flights = await asyncio.gather(
+            *[service.get_flight_by_number("AFL031") for _ in range(10)]
+        )
+        errors = await asyncio.gather(
+            *[service.get_flight_by_number("BROKEN") for _ in range(5)],
+            return_exceptions=True,
+        )
+        await service.close()
+        return service, flights, errors
+
+    service, flights, errors = asyncio.run(main())
+    assert calls == 2
+    assert all(f.flightNumber == "AFL031" for f in flights)
+    assert all(isinstance(e, httpx.HTTPStatusError) for e in errors)
+    assert service.singleflight.stats() == {
+        "calls": 2,
+        "collapsed": 13,
+        "inflight": 0,
+    }
+
+
+def test_flights_are_revalidated(client, backends):
+    first = client.get("/flights", params={"page": 1, "size": 10})
+    second = client.get("/flights", params={"page": 1, "size": 10})
+    assert second.json() == first.json()
+    page = {"page": 1, "pageSize": 10, "totalElements": 1, "items": [FLIGHT]}
+    assert backends.if_none_match == [None, make_etag(json.dumps(page).encode())]
+
+    buy(client)
+    flights_service.cache.clear()
+    buy(client)
+    assert backends.if_none_match[-2:] == [None, make_etag(json.dumps(FLIGHT).encode())]
+    assert flights_service.not_modified == 2
+    assert (
+        client.get("/manage/metrics").json()["flightRepresentations"]["notModified"]
+        == 2
+    )
+
+
+def test_wire_format_negotiation(backends, monkeypatch):
+    assert services.default_headers() == {"Accept": "application/json"}
+
+    monkeypatch.setattr(services, "WIRE_FORMAT", "msgpack")
+    with TestClient(app) as client:
+        buy(client)
+        # the privilege comes back as MessagePack, the tickets as JSON
+        response = client.get("/me", headers={"X-User-Name": "moose"})
+    assert response.status_code == 200
+    assert response.json()["privilege"] == {"balance": 150, "status": "BRONZE"}
+    assert wants_msgpack(backends.accept)
+    assert response.headers["Content-Type"] == "application/json"
+
+
+def test_circuit_breaker():
+    now = [0.0]
+    breaker = CircuitBreaker(failures=2, reset_timeout=10, clock=lambda: now[0])
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10
+
+    now[0] = 10
+    # one probe at a time while half-open
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.cancel()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    now[0] = 20
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
+    assert breaker.stats() == {
+        "state": "closed",
+        "consecutiveFailures": 0,
+        "retryAfter": 0.0,
+        "opened": 2,
+        "rejected": 3,
+    }
+
+
+def test_slow_backend_fails_fast(client, backends, monkeypatch):
+    headers = {"X-User-Name": "moose"}
+    monkeypatch.setattr(privileges_service, "budget", 0.05)
+    privileges_service.breaker = CircuitBreaker(failures=2, reset_timeout=60)
+    backends.delay["bonus"] = 5
+
+    for _ in range(2):
+        start = time.perf_counter()
+        response = client.get("/privilege", headers=headers)
+        assert response.status_code == 504
+        assert time.perf_counter() - start < 1
+
+    # the open circuit refuses calls without reaching the backend
+    backends.delay.clear()
+    response = client.get("/privilege", headers=headers)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "60"
+    assert [c for c in backends.calls if c[0] == "bonus"] == []
+    downstream = client.get("/manage/metrics").json()["downstream"]
+    assert downstream["privileges"]["breaker"]["state"] == "open"
+    assert downstream["flights"]["breaker"]["state"] == "closed"
+    assert client.get("/flights").status_code == 200
+
+    # a successful probe closes it again
+    privileges_service.breaker.reset_timeout = 0
+    assert client.get("/privilege", headers=headers).status_code == 200
+    assert privileges_service.breaker.state == "closed"
+
+
+def test_hedger():
+    hedger = Hedger(percentile=90, max_ratio=0.5, min_samples=5, burst=1)
+    for ms in range(1, 5):
+        hedger.record(ms / 1000)
+    assert hedger.delay() is None
+    for ms in range(5, 11):
+        hedger.record(ms / 1000)
+    assert hedger.delay() == 0.009
+
+    # every call earns half a backup, and at most one is saved up
+    hedger.earn()
+    assert not hedger.acquire()
+    for _ in range(5):
+        hedger.earn()
+    assert hedger.acquire()
+    assert not hedger.acquire()
+    assert hedger.stats()["hedged"] == 1
+    assert hedger.stats()["throttled"] == 2
+
+
+def test_slow_reads_are_hedged(client, backends, monkeypatch):
+    headers = {"X-User-Name": "moose"}
+    monkeypatch.setattr(services, "HEDGE_REQUESTS", True)
+
+    def observed(status):
+        series = services.downstream_duration.series.get(("privileges", "GET", status))
+        return sum(series[0]) if series else 0
+
+    errors, cancelled = observed("error"), observed("cancelled")
+    hedger = Hedger(percentile=50, max_ratio=1, min_samples=1, burst=1)
+    hedger.record(0.01)
+    privileges_service.hedger = hedger
+
+    # the first copy stalls, the backup answers and the stalled one is dropped
+    backends.delay["bonus"] = [5, 0]
+    start = time.perf_counter()
+    assert client.get("/privilege", headers=headers).status_code == 200
+    assert time.perf_counter() - start < 1
+    assert len([c for c in backends.calls if c[0] == "bonus"]) == 1
+    assert hedger.stats()["hedged"] == 1
+    assert hedger.stats()["won"] == 1
+    assert privileges_service.breaker.state == "closed"
+
+    # a fast answer is not hedged at all
+    assert client.get("/privilege", headers=headers).status_code == 200
+    assert hedger.stats()["hedged"] == 1
+    # the dropped copy is not reported as a failing downstream
+    assert observed("cancelled") == cancelled + 1
+    assert observed("error") == errors
+
+    # without budget left the slow copy is waited for
+    hedger.max_ratio = 0
+    hedger.tokens = 0
+    backends.delay["bonus"] = [0.2, 0]
+    start = time.perf_counter()
+    assert client.get("/privilege", headers=headers).status_code == 200
+    assert time.perf_counter() - start >= 0.2
+    metrics = client.get("/manage/metrics").json()
+    hedging = metrics["downstream"]["privileges"]["hedging"]
+    assert hedging["hedged"] == 1
+    assert hedging["throttled"] == 1
+
+
+def test_unreachable_backend(client, backends):
+    headers = {"X-User-Name": "moose"}
+    privileges_service.breaker = CircuitBreaker(failures=2, reset_timeout=60)
+    backends.refuse.add("bonus")
+
+    response = client.get("/privilege", headers=headers)
+    assert response.status_code == 503
+    assert response.json()["message"] == "Сервис privileges недоступен"
+    # the failure that opens the circuit says when to come back
+    response = client.get("/privilege", headers=headers)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "60"
+    assert privileges_service.breaker.state == "open"
+
+
+def test_get_user_not_found(client):
+    response = client.get("/me", headers={"X-User-Name": "nobody"})
+    assert response.status_code == 404
+
+
+def test_get_ticket_wrong_user(client, backends):
+    ticket_uid = buy(client).json()["ticketUid"]
+    response = client.get(f"/tickets/{ticket_uid}", headers={"X-User-Name": "alice"})
+    assert response.status_code == 403
+    response = client.get(f"/tickets/{uuid4()}", headers={"X-User-Name": "moose"})
+    assert response.status_code == 404
+
+
+def test_return_ticket(client, backends):
+    ticket_uid = buy(client).json()["ticketUid"]
+    response = client.delete(f"/tickets/{ticket_uid}", headers={"X-User-Name": "moose"})
+    assert response.status_code == 204
+    assert backends.tickets == {}
+    assert backends.history == []
+
+
+def test_get_privilege(client, backends):
+    buy(client)
+    response = client.get("/privilege", headers={"X-User-Name": "moose"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["balance"] == 150
+    assert len(data["history"]) == 1
+    assert data["history"][0]["operationType"] == "FILL_IN_BALANCE"
+    assert [c for c in backends.calls if c[0] == "bonus"][-1] == (
+        "bonus",
+        "GET",
+        "/privilege/moose/summary",
+    )
+
+
+def test_privilege_history_limit(client, backends):
+    headers = {"X-User-Name": "moose"}
+    for _ in range(3):
+        buy(client)
+    data = client.get("/privilege", headers=headers).json()
+    assert len(data["history"]) == 3
+    data = client.get("/privilege", headers=headers, params={"limit": 2}).json()
+    assert len(data["history"]) == 2
+
+    calls = len(backends.calls)
+    for limit in (0, 5000):
+        response = client.get("/privilege", headers=headers, params={"limit": limit})
+        assert response.status_code == 422
+    assert len(backends.calls) == calls
+
+
+def test_read_responses_keep_their_schema(client, backends):
+    buy(client)
+    headers = {"X-User-Name": "moose"}
+    ticket_uid = next(iter(backends.tickets))
+    for path, model in [
+        ("/me", UserInfoResponse),
+        (f"/tickets/{ticket_uid}", TicketResponse),
+        ("/privilege", PrivilegeInfoResponse),
+        ("/flights", PaginationResponse),
+    ]:
+        response = client.get(path, headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        # what FastAPI's response_model would have sent
+        assert model.model_validate(data).model_dump(mode="json") == data, path
+
+
+def test_exports_are_relayed(client, backends):
+    buy(client)
+    buy(client)
+    headers = {"X-User-Name": "moose"}
+    with client.stream("GET", "/tickets/export", headers=headers) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        tickets = [json.loads(line) for line in response.iter_lines()]
+    assert [t["ticket_uid"] for t in tickets] == list(backends.tickets)
+
+    with client.stream("GET", "/privilege/export", headers=headers) as response:
+        assert response.status_code == 200
+        history = [json.loads(line) for line in response.iter_lines()]
+    assert history == backends.history
+    assert backends.streams_closed == 2
+
+    response = client.get("/privilege/export", headers={"X-User-Name": "nobody"})
+    assert response.status_code == 404
+
+
+def test_metrics(client, backends):
+    buy(client)
+    response = client.get("/manage/metrics")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["inflight"]["current"] == 1
+    assert data["inflight"]["total"] >= 2
+    assert set(data["downstream"]) == {"flights", "tickets", "privileges"}
+    pool = data["downstream"]["tickets"]["pool"]
+    assert pool["active"] == pool["waiting"] == 0
+    assert data["flightCache"]["size"] == 1
+
+
+def test_prometheus_metrics(client, backends):
+    def scrape():
+        response = client.get("/manage/metrics/prometheus")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        lines = response.text.splitlines()
+        return dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+
+    before = scrape()
+    buy(client)
+    client.get(f"/tickets/{uuid4()}", headers={"X-User-Name": "moose"})
+    after = scrape()
+
+    def delta(sample):
+        return float(after.get(sample, 0)) - float(before.get(sample, 0))
+
+    assert (
+        delta(
+            'http_request_duration_seconds_count{method="GET",route="/tickets/{ticket_uid}"}'
+        )
+        == 1
+    )
+    assert (
+        delta('http_requests_total{method="POST",route="/tickets",status="200"}') == 1
+    )
+    assert (
+        delta(
+            'downstream_request_duration_seconds_count{service="tickets",method="POST",status="201"}'
+        )
+        == 1
+    )
+
+
+def test_histogram_render():
+    registry = Registry()
+    histogram = registry.histogram("latency", "help", ("route",), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, '/a"b')
+    assert registry.render().splitlines()[2:] == [
+        'latency_bucket{route="/a\\"b",le="0.1"} 2',
+        'latency_bucket{route="/a\\"b",le="1"} 3',
+        'latency_bucket{route="/a\\"b",le="+Inf"} 4',
+        'latency_sum{route="/a\\"b"} 3.65',
+        'latency_count{route="/a\\"b"} 4',
+    ]
+
+
+def test_benchmark_harness():
+    results = run({"list": lambda: [0] * 1000}, min_time=0.01, repeat=1)
+    assert results["list"]["opsPerSec"] > 0
+    assert results["list"]["retainedBytes"] >= 8000
+    baseline = {
+        "list": {**results["list"], "opsPerSec": results["list"]["opsPerSec"] / 2}
+    }
+    assert compare(results, baseline) == ["list: 2.00x ops/sec, peak +0 bytes"]
+    assert compare(results, {}) == ["list: no baseline"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,122 @@
+"""
+Saturation metrics served by every service on /manage/metrics.
+
+They answer one question when latency spikes: is the service waiting on its
+database pool, on the worker threadpool, on a downstream, or simply busy.
+"""
+
+import time
+import anyio.to_thread
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from common import add_server_timing
+
+
+class InFlight:
+    """
+    Counts HTTP requests currently being handled by the app.
+    """
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self.total = 0
+
+    def stats(self) -> dict:
+        return {"current": self.current, "peak": self.peak, "total": self.total}
+
+
+class InFlightMiddleware:
+    def __init__(self, app, inflight: InFlight):
+        self.app = app
+        self.inflight = inflight
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        inflight = self.inflight
+        inflight.current += 1
+        inflight.total += 1
+        inflight.peak = max(inflight.peak, inflight.current)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            inflight.current -= 1
+
+
+class PoolMetrics:
+    """
+    Tracks connections checked out of an engine's pool and how long sessions
+    waited to get one.
+    """
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self.checked_out = 0
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        event.listen(engine.sync_engine.pool, "checkout", self._on_checkout)
+        event.listen(engine.sync_engine.pool, "checkin", self._on_checkin)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checked_out += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        self.checked_out -= 1
+
+    async def checkout(self, db: AsyncSession):
+        """
+        Acquires the session's connection up front and records the wait.
+        """
+        start = time.perf_counter()
+        await db.connection()
+        elapsed = time.perf_counter() - start
+        self.checkouts += 1
+        self.wait_total += elapsed
+        self.wait_max = max(self.wait_max, elapsed)
+
+    def stats(self) -> dict:
+        pool = self.engine.sync_engine.pool
+        size = getattr(pool, "size", None)
+        overflow = getattr(pool, "overflow", None)
+        return {
+            "pool": type(pool).__name__,
+            "size": size() if size else None,
+            "checkedOut": self.checked_out,
+            # QueuePool.overflow() counts down from -size until the pool is full
+            "overflow": max(overflow(), 0) if overflow else 0,
+            "checkouts": self.checkouts,
+            "waitAvgMs": (
+                self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0
+            ),
+            "waitMaxMs": self.wait_max * 1000,
+        }
+
+
+def track_db_time(engine: AsyncEngine):
+    """
+    Adds the time spent in every statement to the "db" Server-Timing entry of
+    the request that ran it.
+    """
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        add_server_timing("db", time.perf_counter() - conn.info["query_start"].pop())
+
+
+def threadpool_stats() -> dict:
+    """
+    Tokens of the anyio limiter that runs sync endpoints and dependencies.
+    """
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return {
+        "total": limiter.total_tokens,
+        "inUse": limiter.borrowed_tokens,
+        "waiting": limiter.statistics().tasks_waiting,
+    }
@@ -0,0 +1,150 @@
+"""
+Versioned schema migrations for the flights, tickets and bonus services.
+
+Every service declares its MIGRATIONS list in main.py and applies it at
+startup. Applied versions are recorded in a schema_version table inside the
+service's own logical database. To apply them by hand, run:
+
+    python app/migrations.py app/flights
+"""
+
+import argparse
+import asyncio
+import importlib
+import os
+import sys
+from datetime import datetime
+from typing import Callable
+from sqlalchemy import (
+    TIMESTAMP,
+    Column,
+    Connection,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    insert,
+    select,
+    text,
+)
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Arbitrary key serializing concurrent migrators on Postgres
+MIGRATION_LOCK_KEY = 7_316_502
+
+version_table = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", TIMESTAMP, nullable=False),
+)
+
+
+class Migration:
+    def __init__(self, version: int, name: str, upgrade: Callable[[Connection], None]):
+        self.version = version
+        self.name = name
+        self.upgrade = upgrade
+
+
+def create_indexes(model, *names: str):
+    """
+    Upgrade step creating the named indexes declared on an ORM model.
+    """
+    indexes = {index.name: index for index in model.__table__.indexes}
+    missing = set(names) - indexes.keys()
+    if missing:
+        raise ValueError(f"{model.__name__} declares no index {', '.join(missing)}")
+
+    def upgrade(conn: Connection):
+        for name in names:
+            indexes[name].create(conn, checkfirst=True)
+
+    return upgrade
+
+
+def steps(*upgrades: Callable[[Connection], None]):
+    """
+    Upgrade step running several other steps in order.
+    """
+
+    def upgrade(conn: Connection):
+        for step in upgrades:
+            step(conn)
+
+    return upgrade
+
+
+def execute(*statements: str):
+    """
+    Upgrade step running raw SQL statements.
+    """
+
+    def upgrade(conn: Connection):
+        for statement in statements:
+            conn.execute(text(statement))
+
+    return upgrade
+
+
+def _current_version(conn: Connection) -> int:
+    version_table.create(conn, checkfirst=True)
+    versions = conn.execute(select(version_table.c.version)).scalars().all()
+    return max(versions, default=0)
+
+
+def _migrate(conn: Connection, migrations: list[Migration]) -> list[int]:
+    if conn.dialect.name == "postgresql":
+        conn.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+        )
+    version_table.create(conn, checkfirst=True)
+    done = set(conn.execute(select(version_table.c.version)).scalars())
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version in done:
+            continue
+        migration.upgrade(conn)
+        conn.execute(
+            insert(version_table).values(
+                version=migration.version,
+                name=migration.name,
+                applied_at=datetime.now(),
+            )
+        )
+        applied.append(migration.version)
+    return applied
+
+
+async def current_version(engine: AsyncEngine) -> int:
+    async with engine.begin() as conn:
+        return await conn.run_sync(_current_version)
+
+
+async def migrate(engine: AsyncEngine, migrations: list[Migration]) -> list[int]:
+    """
+    Applies pending migrations in version order inside one transaction and
+    returns the versions that were applied.
+    """
+    async with engine.begin() as conn:
+        return await conn.run_sync(_migrate, migrations)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("app_dir", help="service directory, e.g. app/flights")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.abspath(args.app_dir))
+    service = importlib.import_module("main")
+    applied = asyncio.run(migrate(service.engine, service.MIGRATIONS))
+    if applied:
+        print(f"applied migrations: {', '.join(map(str, applied))}")
+    else:
+        version = asyncio.run(current_version(service.engine))
+        print(f"schema is up to date at version {version}")
+
+
+if __name__ == "__main__":
+    main()
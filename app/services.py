@@ -1,55 +1,758 @@
 from common import *
-import requests
+import asyncio
+import functools
+import math
+import os
+import time
+from collections import OrderedDict, deque
+import httpx
+from pydantic import TypeAdapter
 
+# Downstream HTTP client configuration
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "1"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
 
-class FlightsService:
-    def __init__(self, url):
-        self.url = url
+# Circuit breaker of every downstream: consecutive failures that open it and
+# seconds it stays open before a single probe call is let through
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
 
-    def healthcheck(self):
-        response = requests.get(f"{self.url}/manage/health")
-        response.raise_for_status()
+# Concurrent downstream calls allowed per gateway request
+FANOUT_LIMIT = int(os.getenv("FANOUT_LIMIT", "4"))
+
+# Share one in-flight downstream GET between identical concurrent requests
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "1") == "1"
+
+# Hedging of downstream GETs: a backup copy is sent when the first has not
+# answered within the HEDGE_PERCENTILE latency of the service, and backups
+# may add at most HEDGE_MAX_RATIO of extra requests
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.01"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.05"))
+
+# Gateway-side flight cache
+FLIGHT_CACHE_SIZE = int(os.getenv("FLIGHT_CACHE_SIZE", "1024"))
+FLIGHT_CACHE_TTL = float(os.getenv("FLIGHT_CACHE_TTL", "300"))
+FLIGHT_CACHE_NEGATIVE_TTL = float(os.getenv("FLIGHT_CACHE_NEGATIVE_TTL", "30"))
+
+# Must not exceed MAX_BATCH_SIZE of the flights service
+FLIGHTS_BATCH_SIZE = 100
+
+# Body encoding requested from downstreams: "json" or "msgpack". MessagePack
+# bodies are smaller but slower to encode and decode than orjson, so it only
+# pays off where bandwidth is scarcer than CPU. Downstreams or endpoints that
+# only speak JSON answer in JSON, which is read as well.
+WIRE_FORMAT = os.getenv("WIRE_FORMAT", "json")
+
+# Page size of GET /tickets when a cursor comes without a size
+TICKETS_PAGE_SIZE = int(os.getenv("TICKETS_PAGE_SIZE", "100"))
+
+downstream_duration = registry.histogram(
+    "downstream_request_duration_seconds",
+    "Time spent in calls from the gateway to downstream services",
+    ("service", "method", "status"),
+)
+
+
+@functools.cache
+def list_adapter(model) -> TypeAdapter:
+    return TypeAdapter(List[model])
+
+
+def request_key(path, params=None) -> tuple:
+    """
+    Identifies a GET by its path and the query parameters that are set.
+    """
+    if not params:
+        return (path, ())
+    return (path, tuple(sorted((k, v) for k, v in params.items() if v is not None)))
+
+
+def is_msgpack(response: httpx.Response) -> bool:
+    return response.headers.get("Content-Type", "").startswith(MSGPACK_MEDIA_TYPE)
+
+
+def parse(model, response: httpx.Response):
+    """
+    Validates a downstream body in either wire format. JSON goes straight
+    from bytes through pydantic's core instead of json.loads() followed by
+    model_validate().
+    """
+    if is_msgpack(response):
+        return model.model_validate(msgpack_loads(response.content))
+    return model.model_validate_json(response.content)
+
+
+def parse_list(model, response: httpx.Response) -> list:
+    if is_msgpack(response):
+        return list_adapter(model).validate_python(msgpack_loads(response.content))
+    return list_adapter(model).validate_json(response.content)
+
+
+def default_headers() -> dict:
+    if WIRE_FORMAT == "msgpack" and msgpack is not None:
+        return {"Accept": f"{MSGPACK_MEDIA_TYPE}, application/json;q=0.5"}
+    return {"Accept": "application/json"}
+
+
+def default_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def default_timeout() -> httpx.Timeout:
+    return httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+
+def default_budget(service_name: str) -> float:
+    """
+    Total seconds one call to the service may take, including the wait for a
+    pooled connection. <SERVICE>_TIMEOUT, e.g. FLIGHTS_TIMEOUT, overrides it.
+    """
+    return float(os.getenv(f"{service_name.upper()}_TIMEOUT", HTTP_TIMEOUT))
+
+
+class ServiceUnavailable(Exception):
+    """
+    A downstream call failed fast because the service's circuit is open or it
+    could not be reached, or ran out of its time budget.
+    """
+
+    def __init__(self, service: str, reason: str, retry_after: float | None = None):
+        super().__init__(f"{service} service unavailable: {reason}")
+        self.service = service
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire `ttl` seconds after insertion.
+
+    None is cached as a negative result and expires after `negative_ttl`.
+    A cache with maxsize 0 stores nothing.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float, clock=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock or time.monotonic
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=MISSING):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at <= self.clock():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        ttl = self.negative_ttl if value is None else self.ttl
+        self.entries[key] = (value, self.clock() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one.
+
+    The first caller for a key starts the call and later callers await the
+    same result. An exception is raised to every waiter and is not
+    remembered, so the next call after it retries. Cancelling one waiter
+    does not cancel the shared call for the others.
+    """
+
+    def __init__(self):
+        self.inflight: dict = {}
+        self.calls = 0
+        self.collapsed = 0
+
+    async def do(self, key, fn):
+        future = self.inflight.get(key)
+        if future is not None:
+            self.collapsed += 1
+            return await asyncio.shield(future)
+
+        self.calls += 1
+        future = asyncio.ensure_future(fn())
+        self.inflight[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+        return await asyncio.shield(future)
+
+    def _done(self, key, future):
+        self.inflight.pop(key, None)
+        if not future.cancelled():
+            # mark the exception retrieved when every waiter has gone away
+            future.exception()
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "collapsed": self.collapsed,
+            "inflight": len(self.inflight),
+        }
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a downstream after `failures` consecutive failures.
+
+    While open every call is refused at once. After `reset_timeout` seconds
+    the circuit is half-open: a single probe call goes through and closes
+    the circuit if it succeeds or opens it again if it fails, while the
+    other calls are still refused.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failures: int, reset_timeout: float, clock=None):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.clock = clock or time.monotonic
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+        self.opened = 0
+
+    def retry_after(self) -> float:
+        return max(self.opened_at + self.reset_timeout - self.clock(), 0.0)
+
+    def allow(self) -> bool:
+        """
+        Whether a call may go ahead now. An allowed call must report back
+        through success(), failure() or cancel().
+        """
+        if self.state == self.OPEN and self.retry_after() <= 0:
+            self.state = self.HALF_OPEN
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.probing = False
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+
+    def failure(self):
+        self.probing = False
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failures:
+            if self.state != self.OPEN:
+                self.opened += 1
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+
+    def cancel(self):
+        """
+        The call was abandoned by its caller and says nothing about the
+        downstream.
+        """
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutiveFailures": self.consecutive_failures,
+            "retryAfter": self.retry_after() if self.state == self.OPEN else 0.0,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+class Hedger:
+    """
+    Decides when a slow idempotent call gets a backup copy.
+
+    The delay is the `percentile` of the latencies of the last `window`
+    calls, never below `min_delay`, and no call is hedged until
+    `min_samples` of them are known. Every call earns `max_ratio` of a
+    token, up to `burst` tokens, and every backup spends a whole one, so
+    backups add at most `max_ratio` of extra load.
+    """
+
+    def __init__(
+        self,
+        percentile: float,
+        max_ratio: float,
+        min_delay: float = 0.0,
+        window: int = 1000,
+        min_samples: int = 20,
+        burst: float = 10.0,
+    ):
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.burst = burst
+        self.latencies: deque = deque(maxlen=window)
+        self.tokens = 0.0
+        self.samples = 0
+        self.cached_delay: float | None = None
+        self.hedged = 0
+        self.won = 0
+        self.throttled = 0
+
+    def record(self, seconds: float):
+        self.latencies.append(seconds)
+        self.samples += 1
+        # the percentile is sorted out again every few samples, not per call
+        if self.samples % 16 == 0:
+            self.cached_delay = None
+
+    def delay(self) -> float | None:
+        """
+        Seconds to wait for the first copy, or None while too few latencies
+        are known.
+        """
+        if len(self.latencies) < self.min_samples:
+            return None
+        if self.cached_delay is None:
+            latencies = sorted(self.latencies)
+            index = math.ceil(len(latencies) * self.percentile / 100) - 1
+            self.cached_delay = max(latencies[max(index, 0)], self.min_delay)
+        return self.cached_delay
 
-    def get_all(self, page: int = None, size: int = None):
-        response = requests.get(
-            f"{self.url}/flights", params={"page": page, "size": size}
+    def earn(self):
+        self.tokens = min(self.tokens + self.max_ratio, self.burst)
+
+    def acquire(self) -> bool:
+        if self.tokens < 1:
+            self.throttled += 1
+            return False
+        self.tokens -= 1
+        self.hedged += 1
+        return True
+
+    async def run(self, fn):
+        """
+        Awaits fn() and, if it is slower than delay() and the budget allows,
+        a second fn() as well. The first copy to return wins and the other
+        is cancelled. When both fail the first copy's error is raised.
+        """
+
+        async def attempt():
+            start = time.perf_counter()
+            result = await fn()
+            self.record(time.perf_counter() - start)
+            return result
+
+        self.earn()
+        delay = self.delay()
+        tasks = [asyncio.ensure_future(attempt())]
+        if delay is None:
+            return await tasks[0]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self.acquire():
+                return await tasks[0]
+            tasks.append(asyncio.ensure_future(attempt()))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is tasks[1]:
+                            self.won += 1
+                        return task.result()
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "delay": self.delay(),
+            "samples": len(self.latencies),
+            "hedged": self.hedged,
+            "won": self.won,
+            "throttled": self.throttled,
+            "tokens": self.tokens,
+        }
+
+
+class FanOut:
+    """
+    Runs the independent downstream calls of one gateway request concurrently,
+    at most `limit` at a time, and records the wall time of every hop.
+    """
+
+    def __init__(self, limit: int = FANOUT_LIMIT):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.timings: list[tuple[str, float]] = []
+
+    async def call(self, name: str, awaitable):
+        async with self.semaphore:
+            start = time.perf_counter()
+            try:
+                return await awaitable
+            finally:
+                self.timings.append((name, time.perf_counter() - start))
+
+    async def gather(self, **calls):
+        tasks = [
+            asyncio.ensure_future(self.call(name, awaitable))
+            for name, awaitable in calls.items()
+        ]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in self.timings
         )
-        response.raise_for_status()
-        return PaginationResponse.model_validate(response.json())
 
-    def get_flight_by_number(self, flight_number: str) -> FlightResponse:
-        response = requests.get(f"{self.url}/flights/{flight_number}")
-        response.raise_for_status()
-        return FlightResponse.model_validate(response.json())
 
+class BaseService:
+    """
+    Async client for one downstream service.
 
-class TicketsService:
-    def __init__(self, url):
+    Every service owns its own keep-alive connection pool, created by start()
+    and released by close(). The gateway calls both from its lifespan.
+    """
+
+    name = "downstream"
+
+    def __init__(
+        self,
+        url,
+        limits=None,
+        timeout=None,
+        transport=None,
+        budget: float | None = None,
+        breaker: CircuitBreaker | None = None,
+        hedger: Hedger | None = None,
+    ):
         self.url = url
+        self.limits = limits or default_limits()
+        self.timeout = timeout or default_timeout()
+        self.transport = transport
+        self.budget = budget or default_budget(self.name)
+        self.breaker = breaker or CircuitBreaker(
+            BREAKER_FAILURES, BREAKER_RESET_TIMEOUT
+        )
+        self.hedger = hedger or Hedger(
+            HEDGE_PERCENTILE, HEDGE_MAX_RATIO, min_delay=HEDGE_MIN_DELAY
+        )
+        self.client: httpx.AsyncClient | None = None
+        self.singleflight = SingleFlight()
 
-    def healthcheck(self):
-        response = requests.get(f"{self.url}/manage/health")
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.url,
+                limits=self.limits,
+                timeout=self.timeout,
+                transport=self.transport,
+                headers=default_headers(),
+            )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _request(self, method, path, stream=False, **kwargs) -> httpx.Response:
+        """
+        Sends a request carrying the current request ID and folds the
+        downstream's own Server-Timing entries into ours as <service>-<name>.
+
+        The call is refused with ServiceUnavailable while the circuit is
+        open, and gets one as well when the service cannot be reached or
+        the call exceeds its time budget. Timeouts, transport errors and 5xx
+        answers count as failures of the downstream.
+
+        With stream=True the body is left unread and the caller must close
+        the response.
+        """
+        breaker = self.breaker
+        if not breaker.allow():
+            raise ServiceUnavailable(self.name, "circuit open", breaker.retry_after())
+        request_id = request_id_var.get()
+        if request_id is not None:
+            kwargs["headers"] = {
+                **(kwargs.get("headers") or {}),
+                REQUEST_ID_HEADER: request_id,
+            }
+        start = time.perf_counter()
+        status = "error"
+        try:
+            request = self.client.build_request(method, path, **kwargs)
+            try:
+                async with asyncio.timeout(self.budget):
+                    response = await self.client.send(request, stream=stream)
+            except (TimeoutError, httpx.TimeoutException) as e:
+                status = "timeout"
+                breaker.failure()
+                raise ServiceUnavailable(self.name, "timeout") from e
+            except httpx.TransportError as e:
+                breaker.failure()
+                retry_after = None
+                if breaker.state == breaker.OPEN:
+                    retry_after = breaker.retry_after()
+                raise ServiceUnavailable(self.name, "unreachable", retry_after) from e
+            except BaseException:
+                # abandoned by the caller, e.g. a hedge that lost the race
+                status = "cancelled"
+                breaker.cancel()
+                raise
+            status = response.status_code
+            if status >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            timing = response.headers.get("Server-Timing")
+            if timing:
+                for name, seconds in parse_server_timing(timing).items():
+                    add_server_timing(f"{self.name}-{name}", seconds)
+            return response
+        finally:
+            downstream_duration.observe(
+                time.perf_counter() - start, self.name, method, status
+            )
+
+    async def _get(self, path, params=None, headers=None) -> httpx.Response:
+        """
+        GETs are idempotent, so besides being shared between identical
+        concurrent callers a slow one may be hedged with a second copy.
+        """
+        if params:
+            params = {k: v for k, v in params.items() if v is not None}
+
+        def send():
+            return self._request("GET", path, params=params, headers=headers)
+
+        fetch = (lambda: self.hedger.run(send)) if HEDGE_REQUESTS else send
+        if not COALESCE_REQUESTS:
+            return await fetch()
+        key = request_key(path, params)
+        if headers:
+            key += tuple(sorted(headers.items()))
+        return await self.singleflight.do(key, fetch)
+
+    def pool_stats(self) -> dict:
+        """
+        State of the keep-alive pool: open connections, those serving a
+        request, idle ones, and requests queued for a free connection.
+        """
+        stats = {
+            "maxConnections": self.limits.max_connections,
+            "maxKeepalive": self.limits.max_keepalive_connections,
+            "open": 0,
+            "active": 0,
+            "idle": 0,
+            "waiting": 0,
+        }
+        # httpx exposes no public view of its pool; custom transports have none
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        if pool is None:
+            return stats
+        connections = pool.connections
+        idle = sum(1 for c in connections if c.is_idle())
+        stats.update(
+            open=len(connections),
+            active=len(connections) - idle,
+            idle=idle,
+            waiting=sum(1 for r in pool._requests if r.connection is None),
+        )
+        return stats
+
+    async def healthcheck(self):
+        response = await self._get("/manage/health")
         response.raise_for_status()
 
-    def get_user_tickets(self, username) -> list[Ticket]:
-        response = requests.get(f"{self.url}/tickets/user/{username}")
+
+class FlightsService(BaseService):
+    name = "flights"
+
+    def __init__(self, url, cache: TTLCache | None = None, **kwargs):
+        super().__init__(url, **kwargs)
+        self.cache = cache or TTLCache(
+            FLIGHT_CACHE_SIZE, FLIGHT_CACHE_TTL, FLIGHT_CACHE_NEGATIVE_TTL
+        )
+        # Last representation of each resource with its ETag; entries never
+        # expire since every use revalidates them
+        self.representations = TTLCache(FLIGHT_CACHE_SIZE, math.inf, math.inf)
+        self.not_modified = 0
+
+    async def _get_revalidated(self, path, params, handle):
+        """
+        GET sending the ETag of the last representation in If-None-Match.
+        On 304 the model parsed from that representation is returned as is;
+        otherwise handle(response) produces the result.
+        """
+        key = request_key(path, params)
+        stored = self.representations.get(key, None)
+        headers = {"If-None-Match": stored[0]} if stored else None
+        response = await self._get(path, params, headers)
+        if response.status_code == 304 and stored:
+            self.not_modified += 1
+            return stored[1]
+        result = handle(response)
+        etag = response.headers.get("ETag")
+        if response.status_code == 200 and etag:
+            self.representations.set(key, (etag, result))
+        return result
+
+    async def get_all(
+        self, page: int = None, size: int = None, cursor: str = None
+    ) -> PaginationResponse:
+        def handle(response):
+            if response.status_code == 400:
+                raise ValueError(response.json()["detail"])
+            response.raise_for_status()
+            return parse(PaginationResponse, response)
+
+        return await self._get_revalidated(
+            "/flights", {"page": page, "page_size": size, "cursor": cursor}, handle
+        )
+
+    async def get_flight_by_number(self, flight_number: str) -> FlightResponse | None:
+        flight = self.cache.get(flight_number)
+        if flight is not MISSING:
+            return flight
+
+        def handle(response):
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+            return parse(FlightResponse, response)
+
+        flight = await self._get_revalidated(f"/flights/{flight_number}", None, handle)
+        self.cache.set(flight_number, flight)
+        return flight
+
+    async def get_flights_by_numbers(self, flight_numbers) -> dict[str, FlightResponse]:
+        flights = {}
+        missing = []
+        for flight_number in dict.fromkeys(flight_numbers):
+            flight = self.cache.get(flight_number)
+            if flight is MISSING:
+                missing.append(flight_number)
+            elif flight is not None:
+                flights[flight_number] = flight
+
+        for i in range(0, len(missing), FLIGHTS_BATCH_SIZE):
+            chunk = missing[i : i + FLIGHTS_BATCH_SIZE]
+            response = await self._get(
+                "/flights/batch", params={"numbers": ",".join(chunk)}
+            )
+            response.raise_for_status()
+            for flight in parse_list(FlightResponse, response):
+                flights[flight.flightNumber] = flight
+            for flight_number in chunk:
+                self.cache.set(flight_number, flights.get(flight_number))
+        return flights
+
+
+class TicketsService(BaseService):
+    name = "tickets"
+
+    async def get_user_tickets_page(
+        self, username, status=None, limit: int = None, cursor: str = None
+    ) -> tuple[list[Ticket], str | None]:
+        """
+        One page of a user's tickets and the cursor of the next page.
+        """
+        response = await self._get(
+            f"/tickets/user/{username}",
+            params={"status": status, "limit": limit, "cursor": cursor},
+        )
+        if response.status_code == 400:
+            raise ValueError(response.json()["detail"])
         response.raise_for_status()
-        return [Ticket.model_validate(x) for x in response.json()]
+        tickets = parse_list(Ticket, response)
+        return tickets, response.headers.get(NEXT_CURSOR_HEADER)
+
+    async def get_user_tickets(self, username, status=None) -> list[Ticket]:
+        """
+        All tickets of a user in one unpaged call.
+        """
+        tickets, _ = await self.get_user_tickets_page(username, status)
+        return tickets
+
+    async def export_user_tickets(self, username, status=None) -> httpx.Response:
+        """
+        Open NDJSON stream of all tickets of a user; the caller closes it.
+        """
+        params = {"status": status} if status else None
+        response = await self._request(
+            "GET", f"/tickets/user/{username}/export", stream=True, params=params
+        )
+        if response.is_error:
+            await response.aclose()
+            response.raise_for_status()
+        return response
 
-    def get_ticket(self, ticket_uid) -> Ticket | None:
-        response = requests.get(f"{self.url}/tickets/{ticket_uid}")
+    async def get_ticket(self, ticket_uid) -> Ticket | None:
+        response = await self._get(f"/tickets/{ticket_uid}")
         if response.status_code == 404:
             return None
         response.raise_for_status()
-        return Ticket.model_validate(response.json())
+        return parse(Ticket, response)
 
-    def delete_ticket(self, ticket_uid) -> None:
-        response = requests.delete(f"{self.url}/tickets/{ticket_uid}")
+    async def delete_ticket(self, ticket_uid) -> None:
+        response = await self._request("DELETE", f"/tickets/{ticket_uid}")
         response.raise_for_status()
 
-    def create_ticket(self, ticket_uid, username, flight_number, price):
-        response = requests.post(
-            f"{self.url}/tickets",
+    async def create_ticket(self, ticket_uid, username, flight_number, price):
+        response = await self._request(
+            "POST",
+            "/tickets",
             json=TicketCreateRequest(
                 ticketUid=ticket_uid,
                 username=username,
@@ -59,43 +762,107 @@ class TicketsService:
         )
         response.raise_for_status()
 
+    async def create_tickets(self, tickets: list[TicketCreateRequest]):
+        response = await self._request(
+            "POST",
+            "/tickets/bulk",
+            json=TicketBulkCreateRequest(tickets=tickets).model_dump(mode="json"),
+        )
+        response.raise_for_status()
+
+    async def delete_tickets(self, ticket_uids) -> None:
+        response = await self._request(
+            "DELETE", "/tickets", params={"ticket_uid": [str(u) for u in ticket_uids]}
+        )
+        response.raise_for_status()
 
-class PrivilegesService:
-    def __init__(self, url):
-        self.url = url
 
-    def healthcheck(self):
-        response = requests.get(f"{self.url}/manage/health")
+class PrivilegesService(BaseService):
+    name = "privileges"
+
+    async def get_user_privelge(self, username) -> Privilege:
+        response = await self._get(f"/privilege/{username}")
+        if response.status_code == 404:
+            return None
         response.raise_for_status()
+        return parse(Privilege, response)
 
-    def get_user_privelge(self, username) -> Privilege:
-        response = requests.get(f"{self.url}/privilege/{username}")
+    async def get_user_privelge_history(
+        self, username
+    ) -> list[PrivilegeHistory] | None:
+        response = await self._get(f"/privilege/{username}/history")
         if response.status_code == 404:
             return None
         response.raise_for_status()
-        privilege = Privilege.model_validate(response.json())
-        return privilege
+        return parse_list(PrivilegeHistory, response)
+
+    async def export_history(self, username) -> httpx.Response | None:
+        """
+        Open NDJSON stream of a user's privilege history; the caller closes it.
+        """
+        response = await self._request(
+            "GET", f"/privilege/{username}/history/export", stream=True
+        )
+        if response.is_error:
+            await response.aclose()
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+        return response
 
-    def get_user_privelge_history(self, username) -> list[PrivilegeHistory]:
-        response = requests.get(f"{self.url}/privilege/{username}/history")
+    async def get_user_privelge_summary(
+        self, username, limit: int = None, cursor: str = None
+    ) -> PrivilegeSummary | None:
+        response = await self._get(
+            f"/privilege/{username}/summary",
+            params={"limit": limit, "cursor": cursor},
+        )
+        if response.status_code == 404:
+            return None
+        if response.status_code == 400:
+            raise ValueError(response.json()["detail"])
         response.raise_for_status()
-        return [PrivilegeHistory.model_validate(x) for x in response.json()]
+        return parse(PrivilegeSummary, response)
 
-    def get_user_privelge_transaction(self, username, ticket_uid) -> PrivilegeHistory:
-        response = requests.get(f"{self.url}/privilege/{username}/history/{ticket_uid}")
+    async def get_user_privelge_transaction(
+        self, username, ticket_uid
+    ) -> PrivilegeHistory:
+        response = await self._get(f"/privilege/{username}/history/{ticket_uid}")
         if response.status_code == 404:
             return None
         response.raise_for_status()
-        return PrivilegeHistory.model_validate(response.json())
+        return parse(PrivilegeHistory, response)
+
+    async def add_transaction(self, username, data: AddTranscationRequest) -> Privilege:
+        response = await self._request(
+            "POST", f"/privilege/{username}/history", json=data.model_dump(mode="json")
+        )
+        response.raise_for_status()
+        return parse(Privilege, response)
+
+    async def rollback_transaction(self, username, ticket_uid):
+        response = await self._request(
+            "DELETE", f"/privilege/{username}/history/{ticket_uid}"
+        )
+        response.raise_for_status()
 
-    def add_transaction(self, username, data: AddTranscationRequest):
-        response = requests.post(
-            f"{self.url}/privilege/{username}/history", json=data.model_dump(mode="json")
+    async def add_transactions(
+        self, username, transactions: list[AddTranscationRequest]
+    ) -> Privilege:
+        response = await self._request(
+            "POST",
+            f"/privilege/{username}/history/bulk",
+            json=AddTransactionsRequest(transactions=transactions).model_dump(
+                mode="json"
+            ),
         )
         response.raise_for_status()
+        return parse(Privilege, response)
 
-    def rollback_transaction(self, username, ticket_uid):
-        response = requests.delete(
-            f"{self.url}/privilege/{username}/history/{ticket_uid}"
+    async def rollback_transactions(self, username, ticket_uids):
+        response = await self._request(
+            "DELETE",
+            f"/privilege/{username}/history",
+            params={"ticket_uid": [str(u) for u in ticket_uids]},
         )
         response.raise_for_status()
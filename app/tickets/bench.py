@@ -0,0 +1,46 @@
+"""
+Microbenchmarks of the tickets service hot paths. See app/benchmark.py.
+"""
+
+from uuid import uuid4
+import os
+
+os.environ.setdefault("TESTING", "True")
+
+from main import TicketDb
+from common import Ticket, json_dumps
+from benchmark import main
+
+TICKETS = [
+    TicketDb(
+        id=i,
+        ticket_uid=uuid4(),
+        username="moose",
+        flight_number=f"AFL{i % 100:03d}",
+        price=1500,
+        status="PAID",
+    )
+    for i in range(1, 1001)
+]
+# The same tickets as plain column rows, the way the list endpoint reads them
+ROWS = [
+    {c.name: getattr(t, c.name) for c in TicketDb.__table__.columns} for t in TICKETS
+]
+
+
+BENCHMARKS = {
+    "Ticket.model_validate x1000 ORM": lambda: [
+        Ticket.model_validate(t) for t in TICKETS
+    ],
+    "Ticket.model_validate x1000 ORM dump": lambda: [
+        Ticket.model_validate(t).model_dump(mode="json") for t in TICKETS
+    ],
+    "Ticket.model_validate x1000 ORM dump_json": lambda: [
+        Ticket.model_validate(t).model_dump_json() for t in TICKETS
+    ],
+    "json_dumps x1000 rows": lambda: json_dumps(ROWS),
+}
+
+
+if __name__ == "__main__":
+    main(BENCHMARKS)
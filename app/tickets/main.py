@@ -1,10 +1,23 @@
 import uuid
-from fastapi import FastAPI, HTTPException, Depends, Path
-from sqlalchemy import create_engine, Column, Integer, String, UUID
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
-from sqlalchemy import Column, Integer, String, StaticPool
+from fastapi import FastAPI, HTTPException, Depends, Path, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Column, Integer, String, UUID
+from sqlalchemy.orm import declarative_base
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    StaticPool,
+    Index,
+    delete,
+    insert,
+    select,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
 import os
+from contextlib import asynccontextmanager
 import sys
 import inspect
 
@@ -13,6 +26,14 @@ parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 
 from common import *
+from migrations import Migration, create_indexes, execute, migrate, steps
+from metrics import (
+    InFlight,
+    InFlightMiddleware,
+    PoolMetrics,
+    threadpool_stats,
+    track_db_time,
+)
 
 if not os.getenv("TESTING"):
     # Database configuration from environment variables
@@ -21,65 +42,163 @@ if not os.getenv("TESTING"):
     DB_NAME = os.getenv("POSTGRES_DB", "postgres")
     DB_HOST = os.getenv("DB_HOST", "postgres")
     DB_PORT = os.getenv("DB_PORT", "5432")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
 
-    DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    DATABASE_URL = (
+        f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    )
 
     # SQLAlchemy setup
-    engine = create_engine(DATABASE_URL)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine = create_async_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+    SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
     Base = declarative_base()
 else:
     # For tests, create minimal setup
     Base = declarative_base()
 
-    SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+    SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
 
-    engine = create_engine(
+    engine = create_async_engine(
         SQLALCHEMY_DATABASE_URL,
-        connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
+    SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
-app = FastAPI(title="Tickets API")
+RUN_MIGRATIONS = (
+    os.getenv("RUN_MIGRATIONS", "0" if os.getenv("TESTING") else "1") == "1"
+)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if RUN_MIGRATIONS:
+        await migrate(engine, MIGRATIONS)
+    yield
+
+
+app = FastAPI(title="Tickets API", lifespan=lifespan)
+inflight = InFlight()
+app.add_middleware(InFlightMiddleware, inflight=inflight)
+instrument(app)
+pool_metrics = PoolMetrics(engine)
+track_db_time(engine)
+
+
+async def get_db():
+    async with SessionLocal() as db:
+        await pool_metrics.checkout(db)
         yield db
-    finally:
-        db.close()
 
 
 class TicketDb(Base):
     __tablename__ = "ticket"
 
     id = Column(Integer, primary_key=True)
-    ticket_uid = Column(UUID(as_uuid=True), nullable=False)
+    ticket_uid = Column(UUID(as_uuid=True), nullable=False, unique=True)
     username = Column(String(80), nullable=False)
     flight_number = Column(String(20), nullable=False)
     price = Column(Integer, nullable=False)
     status = Column(String(20), nullable=False)
 
+    # Serves both the per-user lookup and its id-ordered pages
+    __table_args__ = (Index("ix_ticket_username_id", "username", "id"),)
+
+
+MIGRATIONS = [
+    Migration(
+        1,
+        "ticket lookup indexes",
+        execute("CREATE INDEX IF NOT EXISTS ix_ticket_username ON ticket (username)"),
+    ),
+    Migration(
+        2,
+        "ticket pagination index",
+        steps(
+            create_indexes(TicketDb, "ix_ticket_username_id"),
+            execute("DROP INDEX IF EXISTS ix_ticket_username"),
+        ),
+    ),
+]
+
 
 @app.get("/tickets/user/{username}", response_model=List[Ticket])
-def get_tickets_by_user(username: str, db: Session = Depends(get_db)):
-    tickets = db.query(TicketDb).filter(TicketDb.username == username).all()
-    return tickets
+async def get_tickets_by_user(
+    username: str,
+    status: Optional[TicketStatus] = Query(None, description="Статус билета"),
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Размер страницы"),
+    cursor: Optional[str] = Query(None, description="Курсор страницы"),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Tickets of a user in id order. With `limit` only one page is returned and
+    the cursor of the next one, if any, is sent in the X-Next-Cursor header.
+    """
+    # Plain columns straight to JSON, without ORM objects or their validation
+    query = select(*TicketDb.__table__.columns).where(TicketDb.username == username)
+    if status is not None:
+        query = query.where(TicketDb.status == status.value)
+    if cursor:
+        try:
+            (after,) = decode_cursor(cursor)
+            after = int(after)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(TicketDb.id > after)
+    query = query.order_by(TicketDb.id)
+
+    if limit is None:
+        tickets = (await db.execute(query)).all()
+        return WireResponse([t._asdict() for t in tickets])
+    tickets = (await db.execute(query.limit(limit + 1))).all()
+    headers = {}
+    if len(tickets) > limit:
+        tickets = tickets[:limit]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(tickets[-1].id)
+    return WireResponse([t._asdict() for t in tickets], headers=headers)
+
+
+@app.get("/tickets/user/{username}/export")
+async def export_tickets_by_user(
+    username: str,
+    status: Optional[TicketStatus] = Query(None, description="Статус билета"),
+    db: AsyncSession = Depends(get_db, scope="request"),
+):
+    """
+    All tickets of a user in id order as NDJSON, read through a server-side
+    cursor.
+    """
+    query = select(*TicketDb.__table__.columns).where(TicketDb.username == username)
+    if status is not None:
+        query = query.where(TicketDb.status == status.value)
+    result = await db.stream(
+        query.order_by(TicketDb.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    return StreamingResponse(ndjson_stream(result), media_type=NDJSON_MEDIA_TYPE)
 
 
 @app.get("/tickets/{ticket_uid}", response_model=Ticket)
-def get_ticket_by_uid(ticket_uid: uuid.UUID, db: Session = Depends(get_db)):
-    ticket = db.query(TicketDb).filter(TicketDb.ticket_uid == ticket_uid).first()
+async def get_ticket_by_uid(ticket_uid: uuid.UUID, db: AsyncSession = Depends(get_db)):
+    ticket = await db.scalar(select(TicketDb).where(TicketDb.ticket_uid == ticket_uid))
     if not ticket:
         raise HTTPException(status_code=404, detail="Ticket not found")
-    return ticket
+    return WireResponse(Ticket.model_validate(ticket))
 
 
 @app.post("/tickets", status_code=201)
-def create_ticket(request: TicketCreateRequest, db: Session = Depends(get_db)):
-    existing = (
-        db.query(TicketDb).filter(TicketDb.ticket_uid == request.ticketUid).first()
+async def create_ticket(
+    request: TicketCreateRequest, db: AsyncSession = Depends(get_db)
+):
+    existing = await db.scalar(
+        select(TicketDb).where(TicketDb.ticket_uid == request.ticketUid)
     )
     if existing:
         raise HTTPException(
@@ -94,19 +213,68 @@ def create_ticket(request: TicketCreateRequest, db: Session = Depends(get_db)):
         status="PAID",
     )
     db.add(new_ticket)
-    db.commit()
+    await db.commit()
+
+
+@app.post("/tickets/bulk", status_code=201)
+async def create_tickets(
+    request: TicketBulkCreateRequest, db: AsyncSession = Depends(get_db)
+):
+    """
+    Inserts the whole batch with one multi-row INSERT. A UUID that already
+    exists, or repeats within the batch, rejects all of it.
+    """
+    try:
+        await db.execute(
+            insert(TicketDb).values(
+                [
+                    {
+                        "ticket_uid": ticket.ticketUid,
+                        "username": ticket.username,
+                        "flight_number": ticket.flightNumber,
+                        "price": ticket.price,
+                        "status": "PAID",
+                    }
+                    for ticket in request.tickets
+                ]
+            )
+        )
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=403, detail="Ticket with this UUID already exists"
+        )
+
+
+@app.delete("/tickets", status_code=204)
+async def delete_tickets(
+    ticket_uid: List[uuid.UUID] = Query(..., max_length=MAX_BULK_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    await db.execute(delete(TicketDb).where(TicketDb.ticket_uid.in_(ticket_uid)))
+    await db.commit()
 
 
 @app.delete("/tickets/{ticket_uid}", status_code=204)
-def delete_ticket(ticket_uid: uuid.UUID, db: Session = Depends(get_db)):
-    ticket = db.query(TicketDb).filter(TicketDb.ticket_uid == ticket_uid).first()
+async def delete_ticket(ticket_uid: uuid.UUID, db: AsyncSession = Depends(get_db)):
+    ticket = await db.scalar(select(TicketDb).where(TicketDb.ticket_uid == ticket_uid))
     if not ticket:
         raise HTTPException(status_code=404, detail="Ticket not found")
 
-    db.delete(ticket)
-    db.commit()
+    await db.delete(ticket)
+    await db.commit()
 
 
 @app.get("/manage/health", status_code=201)
-def health():
+async def health():
     pass
+
+
+@app.get("/manage/metrics")
+async def metrics():
+    return {
+        "inflight": inflight.stats(),
+        "threadpool": threadpool_stats(),
+        "db": pool_metrics.stats(),
+    }
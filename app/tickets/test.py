@@ -1,23 +1,39 @@
+import json
 from datetime import datetime
+from typing import List
 from uuid import uuid4
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import sessionmaker
+from pydantic import TypeAdapter
+from sqlalchemy.ext.asyncio import async_sessionmaker
 import os
 
 os.environ["TESTING"] = "True"
 
 from main import app, get_db, Base, TicketDb, engine
+from common import MSGPACK_MEDIA_TYPE, Ticket, msgpack_loads
+from dbtesting import assert_uses_indexes, count_queries
 
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestingSessionLocal = async_sessionmaker(
+    engine, autoflush=False, expire_on_commit=False
+)
+run = asyncio.run
 
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def drop_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 app.dependency_overrides[get_db] = override_get_db
@@ -29,21 +45,21 @@ def db_session():
     Creates a new database session for a test, using the same engine as the app.
     """
     # Create tables
-    Base.metadata.create_all(bind=engine)
+    run(create_tables())
 
     session = TestingSessionLocal()
     try:
         yield session
     finally:
-        session.close()
-        Base.metadata.drop_all(bind=engine)
+        run(session.close())
+        run(drop_tables())
 
 
 @pytest.fixture
 def client():
-    Base.metadata.create_all(bind=engine)
+    run(create_tables())
     yield TestClient(app)
-    Base.metadata.drop_all(bind=engine)
+    run(drop_tables())
 
 
 @pytest.fixture
@@ -56,7 +72,7 @@ def test_ticket(db_session):
         status="PAID",
     )
     db_session.add(ticket)
-    db_session.commit()
+    run(db_session.commit())
 
     return ticket
 
@@ -89,6 +105,20 @@ def test_get_ticket(client, test_ticket):
     assert data["flight_number"] == test_ticket.flight_number
 
 
+def test_tickets_as_msgpack(client, test_ticket):
+    headers = {"Accept": MSGPACK_MEDIA_TYPE}
+    for url, model in [
+        (f"/tickets/user/{test_ticket.username}", List[Ticket]),
+        (f"/tickets/{test_ticket.ticket_uid}", Ticket),
+    ]:
+        response = client.get(url, headers=headers)
+        assert response.headers["Content-Type"] == MSGPACK_MEDIA_TYPE
+        adapter = TypeAdapter(model)
+        assert adapter.validate_python(
+            msgpack_loads(response.content)
+        ) == adapter.validate_json(client.get(url).content)
+
+
 def test_post_ticket(client):
     uid = uuid4()
     response = client.post(
@@ -106,3 +136,135 @@ def test_post_ticket(client):
     data = response.json()
     assert data["username"] == "moose"
     assert data["flight_number"] == "AAAA"
+
+
+def test_ticket_queries_use_indexes(client, test_ticket):
+    username, ticket_uid = test_ticket.username, test_ticket.ticket_uid
+
+    for method, url in [
+        ("GET", f"/tickets/user/{username}"),
+        ("GET", f"/tickets/{ticket_uid}"),
+        ("DELETE", f"/tickets/{ticket_uid}"),
+    ]:
+        with count_queries(engine) as queries:
+            assert client.request(method, url).status_code < 300
+        assert_uses_indexes(engine, queries)
+
+
+def test_metrics(client, test_ticket, monkeypatch):
+    monkeypatch.delitem(app.dependency_overrides, get_db)
+    for _ in range(3):
+        client.get(f"/tickets/user/{test_ticket.username}")
+
+    response = client.get("/manage/metrics")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["inflight"]["current"] == 1
+    assert data["threadpool"]["inUse"] == 0
+    assert data["db"]["checkouts"] == 3
+    assert data["db"]["checkedOut"] == 0
+    assert data["db"]["overflow"] == 0
+
+
+def test_request_id_and_db_timing(client, test_ticket):
+    response = client.get(
+        f"/tickets/{test_ticket.ticket_uid}", headers={"X-Request-ID": "abc"}
+    )
+    assert response.status_code == 200
+    assert response.headers["X-Request-ID"] == "abc"
+    assert response.headers["Server-Timing"].startswith("db;dur=")
+
+
+def test_access_log(client, test_ticket, caplog):
+    client.get(f"/tickets/{test_ticket.ticket_uid}", headers={"X-Request-ID": "abc"})
+    (record,) = [r for r in caplog.records if r.name == "app.access"]
+    assert record.levelname == "INFO"
+    message = record.getMessage()
+    assert message.startswith(f"abc GET /tickets/{test_ticket.ticket_uid} 200 ")
+    assert "db;dur=" in message
+
+
+def test_bulk_tickets(client):
+    tickets = [
+        {
+            "ticketUid": str(uuid4()),
+            "username": "moose",
+            "flightNumber": "AAAA",
+            "price": p,
+        }
+        for p in (100, 200, 300)
+    ]
+    with count_queries(engine) as queries:
+        response = client.post("/tickets/bulk", json={"tickets": tickets})
+    assert response.status_code == 201
+    assert [q.split()[0] for q, _ in queries] == ["INSERT"]
+    assert len(client.get("/tickets/user/moose").json()) == 3
+
+    # one duplicate rejects the whole batch
+    again = [{**tickets[0], "ticketUid": str(uuid4())}, tickets[1]]
+    response = client.post("/tickets/bulk", json={"tickets": again})
+    assert response.status_code == 403
+    assert len(client.get("/tickets/user/moose").json()) == 3
+
+    response = client.delete(
+        "/tickets", params={"ticket_uid": [t["ticketUid"] for t in tickets[:2]]}
+    )
+    assert response.status_code == 204
+    data = client.get("/tickets/user/moose").json()
+    assert [t["ticket_uid"] for t in data] == [tickets[2]["ticketUid"]]
+
+
+def test_user_tickets_pages(client, db_session):
+    for status in ["PAID", "CANCELED", "PAID", "PAID", "CANCELED"]:
+        db_session.add(
+            TicketDb(
+                ticket_uid=uuid4(),
+                username="moose",
+                flight_number="AAAA",
+                price=1000,
+                status=status,
+            )
+        )
+    run(db_session.commit())
+
+    ids = []
+    params = {"limit": 2}
+    while True:
+        with count_queries(engine) as queries:
+            response = client.get("/tickets/user/moose", params=params)
+        assert response.status_code == 200
+        assert_uses_indexes(engine, queries)
+        ids += [t["id"] for t in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    assert ids == [1, 2, 3, 4, 5]
+
+    response = client.get("/tickets/user/moose", params={"status": "CANCELED"})
+    assert [t["id"] for t in response.json()] == [2, 5]
+    response = client.get("/tickets/user/moose", params={"cursor": "bad"})
+    assert response.status_code == 400
+
+
+def test_export_user_tickets(client, db_session):
+    db_session.add_all(
+        TicketDb(
+            ticket_uid=uuid4(),
+            username="moose",
+            flight_number="AAAA",
+            price=i,
+            status="CANCELED" if i % 3 == 0 else "PAID",
+        )
+        for i in range(700)
+    )
+    run(db_session.commit())
+
+    with client.stream("GET", "/tickets/user/moose/export") as response:
+        assert response.headers["content-type"] == "application/x-ndjson"
+        chunks = list(response.iter_bytes())
+    lines = b"".join(chunks).decode().splitlines()
+    assert [json.loads(line)["price"] for line in lines] == list(range(700))
+
+    response = client.get("/tickets/user/moose/export", params={"status": "CANCELED"})
+    assert len(response.text.splitlines()) == 234
+    assert client.get("/tickets/user/nobody/export").text == ""